@@ -1,11 +1,13 @@
 import logging
 import numpy
-import pandas
 from collections import Counter
 
 logger = logging.getLogger(__name__)
 
 def load_timings(path, y="cost2_p_expl", start=0, finish=3000000, window=100, hours=False):
+    # pandas is only needed for the plots, not by the BLEU helpers
+    import pandas
+
     logging.debug("Loading timings from {}".format(path))
     tm = numpy.load(path)
     num_steps = min(tm['step'], finish)
@@ -3,6 +3,10 @@ import logging
 import pprint
 import operator
 import itertools
+import os
+import sys
+import hashlib
+import cPickle
 
 import theano
 import theano.tensor as TT
@@ -296,6 +300,17 @@ class RecurrentLayerWithSearch(Layer):
             self.params += layer.params
             self.params_grad_scale += layer.params_grad_scale
 
+    def project_annotations(self, c):
+        """Project the source annotations to the tanh layer of the attention.
+
+        The projection depends only on the source sentence,
+        so it can be computed once and given to step_fprop.
+        """
+        p_from_c = utils.dot(c, self.A_cp)
+        if c.ndim == 3:
+            p_from_c = p_from_c.reshape((c.shape[0], c.shape[1], self.n_hids))
+        return p_from_c
+
     def step_fprop(self,
                    state_below,
                    state_before,
@@ -308,7 +323,8 @@ class RecurrentLayerWithSearch(Layer):
                    use_noise=True,
                    no_noise_bias=False,
                    step_num=None,
-                   return_alignment=False):
+                   return_alignment=False,
+                   ctx=None):
         """
         Constructs the computational graph of this layer.
 
@@ -336,6 +352,11 @@ class RecurrentLayerWithSearch(Layer):
         :type no_noise_bias: bool
         :param no_noise_bias: flag saying if weight noise should be added to
             the bias as well
+
+        :type ctx: None or theano variable
+        :param ctx: precomputed weighted sum of the source annotations;
+            when given the attention is not computed again and no
+            alignment can be returned
         """
 
         updater_below = gater_below
@@ -347,46 +368,49 @@ class RecurrentLayerWithSearch(Layer):
         B_hp = self.B_hp
         D_pe = self.D_pe
 
-        # The code works only with 3D tensors
-        cndim = c.ndim
-        if cndim == 2:
-            c = c[:, None, :]
-
-        # Warning: either source_num or target_num should be equal,
-        #          or on of them sould be 1 (they have to broadcast)
-        #          for the following code to make any sense.
-        source_len = c.shape[0]
-        source_num = c.shape[1]
-        target_num = state_before.shape[0]
-        dim = self.n_hids
-
-        # Form projection to the tanh layer from the previous hidden state
-        # Shape: (source_len, target_num, dim)
-        p_from_h = ReplicateLayer(source_len)(utils.dot(state_before, B_hp)).out
-
-        # Form projection to the tanh layer from the source annotation.
-        if not p_from_c:
-            p_from_c =  utils.dot(c, A_cp).reshape((source_len, source_num, dim))
-
-        # Sum projections - broadcasting happens at the dimension 1.
-        p = p_from_h + p_from_c
-
-        # Apply non-linearity and project to energy.
-        energy = TT.exp(utils.dot(TT.tanh(p), D_pe)).reshape((source_len, target_num))
-        if c_mask:
-            # This is used for batches only, that is target_num == source_num
-            energy *= c_mask
-
-        # Calculate energy sums.
-        normalizer = energy.sum(axis=0)
-
-        # Get probabilities.
-        probs = energy / normalizer
-
-        # Calculate weighted sums of source annotations.
-        # If target_num == 1, c shoulds broadcasted at the 1st dimension.
-        # Probabilities are broadcasted at the 2nd dimension.
-        ctx = (c * probs.dimshuffle(0, 1, 'x')).sum(axis=0)
+        if ctx is None:
+            # The code works only with 3D tensors
+            cndim = c.ndim
+            if cndim == 2:
+                c = c[:, None, :]
+
+            # Warning: either source_num or target_num should be equal,
+            #          or on of them sould be 1 (they have to broadcast)
+            #          for the following code to make any sense.
+            source_len = c.shape[0]
+            source_num = c.shape[1]
+            target_num = state_before.shape[0]
+            dim = self.n_hids
+
+            # Form projection to the tanh layer from the previous hidden state
+            # Shape: (source_len, target_num, dim)
+            p_from_h = ReplicateLayer(source_len)(utils.dot(state_before, B_hp)).out
+
+            # Form projection to the tanh layer from the source annotation.
+            if not p_from_c:
+                p_from_c =  utils.dot(c, A_cp).reshape((source_len, source_num, dim))
+
+            # Sum projections - broadcasting happens at the dimension 1.
+            p = p_from_h + p_from_c
+
+            # Apply non-linearity and project to energy.
+            energy = TT.exp(utils.dot(TT.tanh(p), D_pe)).reshape((source_len, target_num))
+            if c_mask:
+                # This is used for batches only, that is target_num == source_num
+                energy *= c_mask
+
+            # Calculate energy sums.
+            normalizer = energy.sum(axis=0)
+
+            # Get probabilities.
+            probs = energy / normalizer
+
+            # Calculate weighted sums of source annotations.
+            # If target_num == 1, c shoulds broadcasted at the 1st dimension.
+            # Probabilities are broadcasted at the 2nd dimension.
+            ctx = (c * probs.dimshuffle(0, 1, 'x')).sum(axis=0)
+        else:
+            probs = None
 
         state_below += self.c_inputer(ctx).out
         reseter_below += self.c_reseter(ctx).out
@@ -459,9 +483,8 @@ class RecurrentLayerWithSearch(Layer):
             else:
                 init_state = TT.alloc(floatX(0), self.n_hids)
 
-        p_from_c =  utils.dot(c, self.A_cp).reshape(
-                (c.shape[0], c.shape[1], self.n_hids))
-        
+        p_from_c = self.project_annotations(c)
+
         if mask:
             sequences = [state_below, mask, updater_below, reseter_below]
             non_sequences = [c, c_mask, p_from_c] 
@@ -966,6 +989,11 @@ class Decoder(EncoderDecoderBase):
             step_num=None,
             mode=EVALUATION,
             given_init_states=None,
+            p_from_c=None,
+            given_contexts=None,
+            return_contexts=False,
+            return_alignment=False,
+            shortlist=None,
             T=1):
         """Create the computational graph of the RNN Decoder.
 
@@ -995,6 +1023,28 @@ class Decoder(EncoderDecoderBase):
             for sampling and beam_search. A list of hidden states
                 matrices for each layer, each matrix is (n_samples, dim)
 
+        :param p_from_c:
+            for sampling and beam_search with the search mechanism.
+                Projection of c computed by project_annotations of the
+                transition layer, shape (seq_len, n_samples or 1, dim).
+
+        :param given_contexts:
+            for sampling and beam_search with the search mechanism.
+                A list of precomputed contexts for each layer, each
+                matrix is (n_samples, c_dim). Saves recomputing the attention.
+
+        :param return_contexts:
+            if mode == beam_search, also return the contexts computed
+                for each layer
+
+        :param return_alignment:
+            if mode == beam_search, also return the attention weights
+                of the last layer, shape (seq_len, n_samples)
+
+        :param shortlist:
+            if mode == beam_search, a vector of target word indices.
+                The probabilities are computed only for these words.
+
         :param T:
             sampling temperature
         """
@@ -1073,6 +1123,9 @@ class Decoder(EncoderDecoderBase):
         contexts = []
         # Default value for alignment must be smth computable
         alignment = TT.zeros((1,))
+        # The attention is not computed for given contexts
+        compute_alignment = ((self.compute_alignment or return_alignment)
+                and not given_contexts)
         for level in range(self.num_levels):
             if level > 0:
                 input_signals[level] += self.inputers[level](hidden_layers[level - 1])
@@ -1086,9 +1139,12 @@ class Decoder(EncoderDecoderBase):
             if self.state['search']:
                 add_kwargs['c'] = c
                 add_kwargs['c_mask'] = c_mask
-                add_kwargs['return_alignment'] = self.compute_alignment
+                add_kwargs['return_alignment'] = compute_alignment
                 if mode != Decoder.EVALUATION:
                     add_kwargs['step_num'] = step_num
+                    add_kwargs['p_from_c'] = p_from_c
+                if given_contexts:
+                    add_kwargs['ctx'] = given_contexts[level]
             result = self.transitions[level](
                     input_signals[level],
                     mask=y_mask,
@@ -1098,7 +1154,7 @@ class Decoder(EncoderDecoderBase):
                     use_noise=mode == Decoder.EVALUATION,
                     **add_kwargs)
             if self.state['search']:
-                if self.compute_alignment:
+                if compute_alignment:
                     #This implicitly wraps each element of result.out with a Layer to keep track of the parameters.
                     #It is equivalent to h=result[0], ctx=result[1] etc. 
                     h, ctx, alignment = result
@@ -1112,6 +1168,10 @@ class Decoder(EncoderDecoderBase):
                 h = result
                 if mode == Decoder.EVALUATION:
                     ctx = c
+                elif c.ndim == 3:
+                    # Batched beam search: c is already gathered
+                    # for every element of the beam.
+                    ctx = c[c_pos]
                 else:
                     ctx = ReplicateLayer(given_init_states[0].shape[0])(c[c_pos]).out
             hidden_layers.append(h)
@@ -1169,7 +1229,11 @@ class Decoder(EncoderDecoderBase):
                         (y.shape[0], y.shape[1], self.state['dim']))).reshape(
                                 readout.out.shape)
         for fun in self.output_nonlinearities:
-            readout = fun(readout)
+            if isinstance(fun, DropOp):
+                # Scaled instead of dropped when decoding
+                readout = fun(readout, use_noise=mode == Decoder.EVALUATION)
+            else:
+                readout = fun(readout)
 
         if mode == Decoder.SAMPLING:
             sample = self.output_layer.get_sample(
@@ -1184,9 +1248,20 @@ class Decoder(EncoderDecoderBase):
             log_prob = self.output_layer.cost_per_sample
             return [sample] + [log_prob] + hidden_layers
         elif mode == Decoder.BEAM_SEARCH:
-            return self.output_layer(
+            add_kwargs = (dict(shortlist=shortlist)
+                    if shortlist is not None else dict())
+            probs = self.output_layer(
                     state_below=readout.out,
-                    temp=T).out
+                    temp=T,
+                    **add_kwargs).out
+            if not (return_contexts or return_alignment):
+                return probs
+            results = [probs]
+            if return_contexts:
+                results += contexts
+            if return_alignment:
+                results.append(alignment)
+            return results
         elif mode == Decoder.EVALUATION:
             return (self.output_layer.train(
                     state_below=readout,
@@ -1219,11 +1294,15 @@ class Decoder(EncoderDecoderBase):
 
         # Arguments that correspond to scan's "non_sequences":
         c = next(args)
-        assert c.ndim == 2
+        assert c.ndim in (2, 3)
         T = next(args)
         assert T.ndim == 0
+        p_from_c = next(args, None)
+        # Only for batches of source sentences (c.ndim == 3)
+        c_mask = next(args, None)
 
-        decoder_args = dict(given_init_states=prev_hidden_states, T=T, c=c)
+        decoder_args = dict(given_init_states=prev_hidden_states, T=T, c=c,
+                c_mask=c_mask, p_from_c=p_from_c)
 
         sample, log_prob = self.build_decoder(y=prev_word, step_num=step_num, mode=Decoder.SAMPLING, **decoder_args)[:2]
         hidden_states = self.build_decoder(y=sample, step_num=step_num, mode=Decoder.SAMPLING, **decoder_args)[2:]
@@ -1243,6 +1322,9 @@ class Decoder(EncoderDecoderBase):
 
         # Pad with final states
         non_sequences = [c, T]
+        if self.state['search']:
+            non_sequences.append(self.transitions[0].project_annotations(c)
+                    .dimshuffle(0, 'x', 1))
 
         outputs, updates = theano.scan(self.sampling_step,
                 outputs_info=states,
@@ -1252,6 +1334,35 @@ class Decoder(EncoderDecoderBase):
                 name="{}_sampler_scan".format(self.prefix))
         return (outputs[0], outputs[1]), updates
 
+    def build_batch_sampler(self, n_samples, n_steps, T, c, c_mask):
+        """Sample n_samples translations of every sentence of a batch at once.
+
+        :param c:
+            annotations of a batch, shape (max_seq_len, batch_size, c_dim)
+
+        :param c_mask:
+            their 0/1 mask, shape (max_seq_len, batch_size)
+
+        The samples of the sentence i are the columns
+        i * n_samples ... (i + 1) * n_samples - 1 of the results.
+        """
+        assert self.state['search'], "Only the search mechanism supports batches"
+        c = c.repeat(n_samples, axis=1)
+        c_mask = c_mask.repeat(n_samples, axis=1)
+        states = [TT.zeros(shape=(c.shape[1],), dtype='int64'),
+                TT.zeros(shape=(c.shape[1],), dtype='float32')]
+        init_c = c[0, :, -self.state['dim']:]
+        states += [init(init_c).out for init in self.initializers]
+
+        non_sequences = [c, T, self.transitions[0].project_annotations(c), c_mask]
+        outputs, updates = theano.scan(self.sampling_step,
+                outputs_info=states,
+                non_sequences=non_sequences,
+                sequences=[TT.arange(n_steps, dtype="int64")],
+                n_steps=n_steps,
+                name="{}_batch_sampler_scan".format(self.prefix))
+        return (outputs[0], outputs[1]), updates
+
     def build_next_probs_predictor(self, c, step_num, y, init_states):
         return self.build_decoder(c, y, mode=Decoder.BEAM_SEARCH,
                 given_init_states=init_states, step_num=step_num)
@@ -1260,6 +1371,51 @@ class Decoder(EncoderDecoderBase):
         return self.build_decoder(c, y, mode=Decoder.SAMPLING,
                 given_init_states=init_states, step_num=step_num)[2:]
 
+    def build_beam_step(self, c, step_num, y, prev_states, prev_contexts,
+            c_mask=None, p_from_c=None, shortlist=None, return_alignment=False):
+        """Create the computational graph of one fused beam search step.
+
+        First the words chosen at the previous step are consumed to
+        update the hidden states, then the probabilities of the next
+        words are computed. With the search mechanism the contexts of the
+        previous step are reused for the update, so that the attention
+        is computed only once per step. At the step 0 the given states
+        are the initial ones and are not updated.
+
+        :param prev_contexts:
+            contexts of the previous step for each layer if the search
+            mechanism is used, an empty list otherwise
+
+        :param p_from_c:
+            see build_decoder
+
+        :param shortlist:
+            see build_decoder
+
+        :param return_alignment:
+            also return the source position of the highest attention
+                for every beam element
+
+        :returns: [next_probs] + states + contexts (+ [alignment])
+        """
+        new_states = self.build_decoder(c, y, c_mask=c_mask,
+                mode=Decoder.SAMPLING,
+                given_init_states=prev_states,
+                given_contexts=prev_contexts,
+                step_num=step_num - 1)[2:]
+        states = ifelse(TT.gt(step_num, 0), new_states, list(prev_states))
+        outputs = self.build_decoder(c, y, c_mask=c_mask,
+                mode=Decoder.BEAM_SEARCH,
+                given_init_states=states,
+                p_from_c=p_from_c,
+                return_contexts=True,
+                return_alignment=return_alignment,
+                shortlist=shortlist,
+                step_num=step_num)
+        contexts = outputs[1:1 + self.num_levels] if self.state['search'] else []
+        alignment = [outputs[-1].argmax(axis=0)] if return_alignment else []
+        return outputs[:1] + states + contexts + alignment
+
 class RNNEncoderDecoder(object):
     """This class encapsulates the translation model.
 
@@ -1349,8 +1505,10 @@ class RNNEncoderDecoder(object):
                 skip_init=self.skip_init, compute_alignment=self.compute_alignment)
         self.decoder.create_layers()
         logger.debug("Build log-likelihood computation graph")
+        # Annotations of the batch x, shape (max_seq_len, batch_size, c_dim)
+        self.training_c = Concatenate(axis=2)(*training_c_components)
         self.predictions, self.alignment = self.decoder.build_decoder(
-                c=Concatenate(axis=2)(*training_c_components), c_mask=self.x_mask,
+                c=self.training_c, c_mask=self.x_mask,
                 y=self.y, y_mask=self.y_mask)
 
         # Annotation for sampling
@@ -1380,6 +1538,12 @@ class RNNEncoderDecoder(object):
                     (self.backward_sampling_c[0]))
 
         self.sampling_c = Concatenate(axis=1)(*sampling_c_components).out
+        # Projections of the annotations used by the attention,
+        # computed once per sentence for decoding.
+        self.sampling_projections = []
+        if self.state['search']:
+            self.sampling_projections.append(
+                    self.decoder.transitions[0].project_annotations(self.sampling_c))
         (self.sample, self.sample_log_prob), self.sampling_updates =\
             self.decoder.build_sampler(self.n_samples, self.n_steps, self.T,
                     c=self.sampling_c)
@@ -1391,12 +1555,29 @@ class RNNEncoderDecoder(object):
                 for i in range(self.decoder.num_levels)]
         self.gen_y = TT.lvector("gen_y")
 
+        logger.debug("Create auxiliary variables for batched beam search")
+        # Padded annotations of several source sentences,
+        # shape (max_seq_len, n_sentences, c_dim), and their mask.
+        self.batch_c = TT.tensor3("batch_c")
+        self.batch_c_mask = TT.matrix("batch_c_mask")
+        self.batch_projections = [TT.tensor3("batch_p_from_c")
+                for p in self.sampling_projections]
+        # For every row of the stacked beams, the index of the
+        # sentence it belongs to.
+        self.beam_origins = TT.lvector("beam_origins")
+        # Contexts computed at the previous step of beam search
+        self.current_contexts = ([TT.matrix("cur_ctx_{}".format(i))
+                for i in range(self.decoder.num_levels)]
+            if self.state['search'] else [])
+        # Target words the beam search is restricted to
+        self.shortlist = TT.lvector("shortlist")
+
     def create_lm_model(self):
         if hasattr(self, 'lm_model'):
             return self.lm_model
         self.lm_model = LM_Model(
             cost_layer=self.predictions,
-            sample_fn=self.create_sampler(),
+            sample_fn=self._lazy_sampler,
             weight_noise_amount=self.state['weight_noise_amount'],
             indx_word=self.state['indx_word_target'],
             indx_word_src=self.state['indx_word'],
@@ -1406,14 +1587,118 @@ class RNNEncoderDecoder(object):
             pprint.pformat(sorted([p.name for p in self.lm_model.params]))))
         return self.lm_model
 
+    def _lazy_sampler(self, *args):
+        """The sampler of the LM model, compiled when first used."""
+        return map(lambda x : x.squeeze(),
+                self.create_sampler(many_samples=True)(1, *args))
+
+    def _compiled_functions(self):
+        return dict((name, value) for name, value in self.__dict__.items()
+                if isinstance(value, theano.compile.function_module.Function))
+
+    def function_cache_path(self, directory):
+        """The file of the compiled functions for this state."""
+        key = hashlib.md5(repr((sorted(self.state.items()),
+            self.compute_alignment, theano.__version__,
+            theano.config.floatX, theano.config.device))).hexdigest()
+        return os.path.join(directory, "functions_{}.pkl".format(key))
+
+    def load_functions(self, directory):
+        """Load the compiled functions saved by save_functions.
+
+        Must be called after the parameters are loaded: their current
+        values are given to the loaded functions. The create_smth
+        methods then return the loaded functions instead of compiling.
+        Returns True if there was something to load.
+        """
+        path = self.function_cache_path(directory)
+        if not os.path.exists(path):
+            logger.debug("No compiled functions in {}".format(path))
+            self._saved_functions = set()
+            return False
+        with open(path, 'rb') as src:
+            functions = cPickle.load(src)
+        params = dict((p.name, p) for p in self.create_lm_model().params)
+        for name, fn in functions.items():
+            for inp, container in zip(fn.maker.inputs, fn.input_storage):
+                if inp.implicit and inp.variable.name in params:
+                    container.value = params[inp.variable.name].get_value(borrow=True)
+            setattr(self, name, fn)
+        self._saved_functions = set(functions)
+        logger.debug("Loaded compiled functions {} from {}".format(
+            sorted(functions), path))
+        return True
+
+    def save_functions(self, directory):
+        """Save all the compiled functions if there are new ones.
+
+        The parameter values are not saved with the functions, see
+        load_functions.
+        """
+        functions = self._compiled_functions()
+        if set(functions) <= getattr(self, '_saved_functions', set()):
+            return
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = self.function_cache_path(directory)
+
+        # Replace the parameters by empty arrays while pickling
+        params = self.create_lm_model().params
+        values = [p.get_value(borrow=True) for p in params]
+        for p in params:
+            p.set_value(numpy.zeros([int(b) for b in p.broadcastable],
+                dtype=p.dtype))
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+        try:
+            with open(path + ".tmp", 'wb') as dst:
+                cPickle.dump(functions, dst, protocol=cPickle.HIGHEST_PROTOCOL)
+            os.rename(path + ".tmp", path)
+        finally:
+            for p, value in zip(params, values):
+                p.set_value(value, borrow=True)
+        self._saved_functions = set(functions)
+        logger.debug("Saved compiled functions {} to {}".format(
+            sorted(functions), path))
+
     def create_representation_computer(self):
+        """Compile the encoder for one sentence.
+
+        The returned function gives [c] + projections, where
+        projections are the attention projections of c for RNNsearch
+        and an empty list otherwise.
+        """
         if not hasattr(self, "repr_fn"):
             self.repr_fn = theano.function(
                     inputs=[self.sampling_x],
-                    outputs=[self.sampling_c],
+                    outputs=[self.sampling_c] + self.sampling_projections,
                     name="repr_fn")
         return self.repr_fn
 
+    def create_batch_representation_computer(self):
+        """Compile the encoder for a padded batch of sentences.
+
+        The returned function takes x and x_mask as in training and gives
+        (c, projections, initial states): the annotations of the batch,
+        shape (max_seq_len, batch_size, c_dim), their attention projections
+        (see create_representation_computer) and the initial decoder
+        states of every layer, shape (batch_size, dim).
+        """
+        if not hasattr(self, "batch_repr_fn"):
+            c = self.training_c.out
+            projections = ([self.decoder.transitions[0].project_annotations(c)]
+                    if self.state['search'] else [])
+            self.batch_repr_fn = theano.function(
+                    inputs=[self.x, self.x_mask],
+                    outputs=[c] + projections + self.decoder.build_initializers(
+                        c[0, :, -self.state['dim']:]),
+                    name="batch_repr_fn")
+        n_projections = len(self.sampling_projections)
+        def compute(x, x_mask):
+            outputs = self.batch_repr_fn(x, x_mask)
+            return (outputs[0], outputs[1:1 + n_projections],
+                    outputs[1 + n_projections:])
+        return compute
+
     def create_initializers(self):
         if not hasattr(self, "init_fn"):
             init_c = self.sampling_c[0, -self.state['dim']:]
@@ -1438,6 +1723,28 @@ class RNNEncoderDecoder(object):
             return sampler
         return self.sample_fn
 
+    def create_batch_sampler(self):
+        """Compile a sampler for a padded batch of source sentences.
+
+        The returned function takes the number of samples per sentence,
+        the number of steps, the inverse temperature and the batch as
+        x, x_mask of the training. It returns the sampled words and their
+        log-probabilities, both (n_steps, batch_size * n_samples) matrices.
+        See Decoder.build_batch_sampler for the order of the columns.
+        """
+        if not hasattr(self, 'batch_sample_fn'):
+            logger.debug("Compile batch sampler")
+            (sample, log_prob), updates = self.decoder.build_batch_sampler(
+                    self.n_samples, self.n_steps, self.T,
+                    self.training_c.out, self.x_mask)
+            self.batch_sample_fn = theano.function(
+                    inputs=[self.n_samples, self.n_steps, self.T,
+                        self.x, self.x_mask],
+                    outputs=[sample, log_prob],
+                    updates=updates,
+                    name="batch_sample_fn")
+        return self.batch_sample_fn
+
     def create_scorer(self, batch=False):
         if not hasattr(self, 'score_fn'):
             logger.debug("Compile scorer")
@@ -1472,6 +1779,45 @@ class RNNEncoderDecoder(object):
                     name="next_states_fn")
         return self.next_states_fn
 
+    def create_beam_step_computer(self, shortlist=False, alignment=False):
+        """Compile the fused step of the batched beam search.
+
+        The returned function takes the padded annotations, their mask,
+        the padded projections (for RNNsearch), the sentence index of every
+        beam element, the step number, the previously chosen words, the
+        states and (for RNNsearch) the contexts. It returns
+        [next_probs] + states + contexts.
+
+        If `shortlist` is True, the function takes a vector of target
+        word indices as the last argument and the next probabilities
+        are computed only for these words.
+
+        If `alignment` is True (RNNsearch only), the source position
+        of the highest attention of every beam element is returned last.
+        """
+        name = (('shortlist_' if shortlist else '')
+                + ('alignment_' if alignment else '') + 'beam_step_fn')
+        if not hasattr(self, name):
+            c = self.batch_c[:, self.beam_origins]
+            c_mask = self.batch_c_mask[:, self.beam_origins]
+            p_from_c = (self.batch_projections[0][:, self.beam_origins]
+                    if self.batch_projections else None)
+            extra_inputs = [self.shortlist] if shortlist else []
+            setattr(self, name, theano.function(
+                    inputs=[self.batch_c, self.batch_c_mask]
+                        + self.batch_projections
+                        + [self.beam_origins, self.step_num, self.gen_y]
+                        + self.current_states + self.current_contexts
+                        + extra_inputs,
+                    outputs=self.decoder.build_beam_step(
+                        c, self.step_num, self.gen_y,
+                        self.current_states, self.current_contexts,
+                        c_mask=c_mask, p_from_c=p_from_c,
+                        shortlist=self.shortlist if shortlist else None,
+                        return_alignment=alignment),
+                    name=name,
+                    on_unused_input='warn'))
+        return getattr(self, name)
 
     def create_probs_computer(self, return_alignment=False):
         if not hasattr(self, 'probs_fn'):
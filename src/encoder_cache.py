@@ -0,0 +1,142 @@
+"""A cache of the encoder outputs of source sequences.
+
+The same source sentences and phrases are often encoded many times,
+e.g. all the subphrases of a sentence by segment.py or the same test
+set by several runs. EncoderCache keeps the results of the encoder for
+the recently seen sequences.
+"""
+
+import collections
+import logging
+import os
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+def _nbytes(value):
+    return sum(array.nbytes for arrays in value for array in arrays)
+
+class EncoderCache(object):
+    """An LRU cache of lists of lists of arrays keyed by word sequences.
+
+    The least recently used entries are evicted when the entries take
+    more than `max_bytes`. If `disk_path` is given, the evicted entries
+    are moved to a memory mapped file of `disk_bytes` bytes, where the
+    oldest ones are overwritten when it is full.
+
+    The file is created when it is first needed. A process forked from
+    the one the cache was created in, e.g. a worker of sample.py, writes
+    its own file `disk_path`.<pid> and does not see the entries on disk
+    of the other processes.
+
+    The numbers of hits in memory, hits on disk and misses are kept in
+    `hits`, `disk_hits` and `misses`.
+    """
+
+    # Entries on disk start at multiples of this
+    ALIGNMENT = 16
+
+    def __init__(self, max_bytes, disk_path=None, disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.disk_path = disk_path
+        self.disk_bytes = disk_bytes
+        self.pid = os.getpid()
+        # The file of the process it was opened in
+        self.disk = None
+        self.disk_pid = None
+        self.disk_pos = 0
+        # key -> (start, end, layout), in the order they were written
+        self.disk_entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, seq, compute):
+        """The cached value for the sequence, `compute(seq)` if there is none."""
+        key = tuple(int(word) for word in seq)
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.hits += 1
+        elif self._open_disk() is not None and key in self.disk_entries:
+            self.disk_hits += 1
+            value = self._read(*self.disk_entries[key])
+            self.n_bytes += _nbytes(value)
+        else:
+            self.misses += 1
+            value = compute(seq)
+            self.n_bytes += _nbytes(value)
+        self.entries[key] = value
+        self._evict()
+        return value
+
+    def stats(self):
+        requests = self.hits + self.disk_hits + self.misses
+        return dict(hits=self.hits, disk_hits=self.disk_hits,
+                misses=self.misses, entries=len(self.entries),
+                bytes=self.n_bytes,
+                disk_entries=len(self.disk_entries),
+                hit_rate=float(self.hits + self.disk_hits) / max(requests, 1))
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            self.n_bytes -= _nbytes(value)
+            if self._open_disk() is not None and key not in self.disk_entries:
+                self._write(key, value)
+
+    def _open_disk(self):
+        """The memory mapped file of the current process, None without
+        `disk_path`. The entries written by another process are dropped."""
+        if self.disk_path and self.disk_pid != os.getpid():
+            self.disk_pid = os.getpid()
+            path = self.disk_path
+            if self.disk_pid != self.pid:
+                path = "{}.{}".format(self.disk_path, self.disk_pid)
+            self.disk = numpy.memmap(path, dtype="uint8", mode="w+",
+                    shape=(self.disk_bytes,))
+            self.disk_pos = 0
+            self.disk_entries = collections.OrderedDict()
+        return self.disk
+
+    def _write(self, key, value):
+        size = sum(_aligned(array.nbytes) for arrays in value for array in arrays)
+        if size > len(self.disk):
+            return
+        if self.disk_pos + size > len(self.disk):
+            # Start over, the entries left after the current position
+            # are the oldest ones
+            while (self.disk_entries and
+                    next(self.disk_entries.itervalues())[0] >= self.disk_pos):
+                self.disk_entries.popitem(last=False)
+            self.disk_pos = 0
+        start, end = self.disk_pos, self.disk_pos + size
+        # Drop the oldest entries, the ones to be overwritten
+        while self.disk_entries:
+            old_start, old_end, _ = next(self.disk_entries.itervalues())
+            if old_start >= end or old_end <= start:
+                break
+            self.disk_entries.popitem(last=False)
+
+        layout = []
+        pos = start
+        for arrays in value:
+            layout.append([])
+            for array in arrays:
+                array = numpy.ascontiguousarray(array)
+                self.disk[pos:pos + array.nbytes] = array.view("uint8").ravel()
+                layout[-1].append((pos, array.dtype, array.shape))
+                pos += _aligned(array.nbytes)
+        self.disk_entries[key] = (start, end, layout)
+        self.disk_pos = end
+
+    def _read(self, start, end, layout):
+        return [[numpy.array(self.disk[pos:pos + dtype.itemsize * int(numpy.prod(shape))])
+                .view(dtype).reshape(shape)
+            for pos, dtype, shape in arrays] for arrays in layout]
+
+def _aligned(n_bytes):
+    alignment = EncoderCache.ALIGNMENT
+    return (n_bytes + alignment - 1) // alignment * alignment
@@ -965,7 +965,8 @@ class SoftmaxLayer(CostLayer):
               additional_inputs=None,
               no_noise_bias=False,
               target=None,
-              full_softmax=True):
+              full_softmax=True,
+              shortlist=None):
         """
         Forward pass through the cost layer.
 
@@ -984,6 +985,10 @@ class SoftmaxLayer(CostLayer):
         :type no_noise_bias: bool
         :param no_noise_bias: flag, stating if weight noise should be added
             to the bias as well, or only to the weights
+
+        :type shortlist: None or tensor vector of ints
+        :param shortlist: if given, the softmax is computed only over these
+            output units, in this order
         """
         if not full_softmax:
             assert target != None, 'target must be given'
@@ -1002,6 +1007,12 @@ class SoftmaxLayer(CostLayer):
             emb_val = state_below
 
         if full_softmax:
+            b_em = self.b_em
+            if shortlist is not None:
+                W_em = W_em[:, shortlist]
+                b_em = b_em[shortlist]
+                if self.weight_noise and use_noise and self.noise_params:
+                    nW_em = nW_em[:, shortlist]
             if self.weight_noise and use_noise and self.noise_params:
                 emb_val = TT.dot(emb_val, W_em + nW_em)
             else:
@@ -1018,9 +1029,12 @@ class SoftmaxLayer(CostLayer):
                         emb_val += utils.dot(inp, weight)
             if self.weight_noise and use_noise and self.noise_params and \
                not no_noise_bias:
-                emb_val = temp * (emb_val + self.b_em + self.nb_em)
+                nb_em = self.nb_em
+                if shortlist is not None:
+                    nb_em = nb_em[shortlist]
+                emb_val = temp * (emb_val + b_em + nb_em)
             else:
-                emb_val = temp * (emb_val + self.b_em)
+                emb_val = temp * (emb_val + b_em)
         else:
             W_em = W_em[:, target]
             if self.weight_noise:
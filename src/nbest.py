@@ -0,0 +1,116 @@
+"""N-best lists of translations.
+
+The text format has a line per hypothesis,
+"sentence ||| translation ||| cost" followed by
+"||| word log-probabilities" and "||| alignment" if they are written.
+The alignment gives for every target word the source position
+the attention was the highest at.
+
+The binary format consists of flat files that are appended to while
+translating and can be memory mapped by load_nbest:
+
+- PREFIX.index: a record of NBEST_DTYPE per hypothesis,
+- PREFIX.words: the word indices of all the hypotheses (int32),
+- PREFIX.logprobs: the log-probabilities of these words (float32),
+  only if they are written,
+- PREFIX.align: the alignment of these words (int32), only if it is
+  written.
+
+The words of a hypothesis are words[start:start + length], the end of
+sequence included.
+"""
+
+import os
+
+import numpy
+
+NBEST_DTYPE = numpy.dtype([('sentence', 'int64'), ('rank', 'int32'),
+    ('cost', 'float32'), ('start', 'int64'), ('length', 'int32')])
+
+class NBestWriter(object):
+
+    def __init__(self, path, binary=False, log_probs=False, alignments=False):
+        """
+        :param path:
+            the text file or, for the binary format, the prefix of the files
+
+        :param log_probs:
+            write the log-probability of every word
+
+        :param alignments:
+            write the alignment of every word
+        """
+        self.binary = binary
+        self.log_probs = log_probs
+        self.alignments = alignments
+        self.n_words = 0
+        if binary:
+            self.index = open(path + ".index", "wb")
+            self.words = open(path + ".words", "wb")
+            self.word_log_probs = (open(path + ".logprobs", "wb")
+                    if log_probs else None)
+            self.word_alignments = (open(path + ".align", "wb")
+                    if alignments else None)
+        else:
+            self.text = open(path, "w")
+
+    def write(self, sentence, translations, costs, trans, log_probs=None,
+            alignments=None):
+        """Write the hypotheses of a sentence.
+
+        :param translations: the hypotheses as strings
+        :param trans: the hypotheses as word indices
+        :param log_probs: the log-probabilities of their words
+        :param alignments: the alignments of their words
+        """
+        if self.binary:
+            records = numpy.zeros(len(trans), dtype=NBEST_DTYPE)
+            records['sentence'] = sentence
+            records['rank'] = numpy.arange(len(trans))
+            records['cost'] = costs
+            records['length'] = map(len, trans)
+            records['start'] = self.n_words + numpy.cumsum(
+                    records['length']) - records['length']
+            records.tofile(self.index)
+            if len(trans):
+                numpy.hstack(trans).astype("int32").tofile(self.words)
+                if self.log_probs:
+                    numpy.hstack(log_probs).astype("float32").tofile(
+                            self.word_log_probs)
+                if self.alignments:
+                    numpy.hstack(alignments).astype("int32").tofile(
+                            self.word_alignments)
+            self.n_words += records['length'].sum()
+        else:
+            for i in range(len(trans)):
+                fields = [str(sentence), translations[i], str(costs[i])]
+                if self.log_probs:
+                    fields.append(" ".join("{:.4f}".format(p)
+                        for p in log_probs[i]))
+                if self.alignments:
+                    fields.append(" ".join(map(str, alignments[i])))
+                print >>self.text, " ||| ".join(fields)
+
+    def close(self):
+        files = ([self.index, self.words, self.word_log_probs,
+            self.word_alignments]
+                if self.binary else [self.text])
+        for f in files:
+            if f:
+                f.close()
+
+def load_nbest(prefix):
+    """Memory map the files of a binary n-best list.
+
+    Returns the index records, the words, the log-probabilities and
+    the alignments (None if they were not written).
+    """
+    index = numpy.memmap(prefix + ".index", dtype=NBEST_DTYPE, mode="r")
+    words = numpy.memmap(prefix + ".words", dtype="int32", mode="r")
+    log_probs = None
+    if os.path.exists(prefix + ".logprobs"):
+        log_probs = numpy.memmap(prefix + ".logprobs", dtype="float32", mode="r")
+    alignments = None
+    if os.path.exists(prefix + ".align"):
+        alignments = numpy.memmap(prefix + ".align", dtype="int32", mode="r")
+    return index, words, log_probs, alignments
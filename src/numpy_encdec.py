@@ -0,0 +1,367 @@
+"""Forward pass of RNNsearch in plain NumPy.
+
+NumpyEncoderDecoder reads the model.npz saved by the Theano model and
+computes what beam search needs: the annotations of a source sentence,
+the initial decoder state and the fused decoder step. It provides the
+create_smth methods that BeamSearch uses of RNNEncoderDecoder, so it can
+be given to BeamSearch instead of it. Nothing is compiled, so it starts at
+once and runs where Theano is not available.
+
+Only the configuration used for RNNsearch is supported: one level of
+gated recurrent units in the bidirectional encoder and in the decoder
+with the search mechanism.
+"""
+
+import functools
+import logging
+import cPickle
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+def _sigmoid(x):
+    return 1. / (1. + numpy.exp(-x))
+
+class _NNet(object):
+    sigmoid = staticmethod(_sigmoid)
+
+class _TT(object):
+    """The part of theano.tensor used by the activations in the states."""
+    tanh = staticmethod(numpy.tanh)
+    exp = staticmethod(numpy.exp)
+    maximum = staticmethod(numpy.maximum)
+    nnet = _NNet
+
+class Maxout(object):
+
+    def __init__(self, maxout_part):
+        self.maxout_part = int(maxout_part)
+
+    def __call__(self, x):
+        return x.reshape(x.shape[:-1]
+                + (x.shape[-1] / self.maxout_part, self.maxout_part)).max(-1)
+
+def _activation(expr):
+    """Evaluate an activation given in the state with NumPy functions."""
+    return eval(expr, {'TT': _TT, 'numpy': numpy, 'Maxout': Maxout})
+
+class QuantizedMatrix(object):
+    """An int8 matrix with a float32 scale for every row.
+
+    Only the rows or columns used are dequantized, a product x W is
+    computed as (x * scales) Q.
+    """
+
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def rows(self, indices):
+        return self.values[indices] * self.scales[indices][..., None]
+
+    def columns(self, indices):
+        return QuantizedMatrix(self.values[:, indices], self.scales)
+
+    def rdot(self, x):
+        return numpy.dot(x * self.scales, self.values)
+
+# The key of the scales of the quantized matrix `name` in model files
+SCALES_SUFFIX = ".scales"
+
+def _rows(W, indices):
+    if isinstance(W, QuantizedMatrix):
+        return W.rows(indices)
+    return numpy.asarray(W[indices], dtype="float32")
+
+def _columns(W, indices):
+    if isinstance(W, QuantizedMatrix):
+        return W.columns(indices)
+    return W[:, indices]
+
+def _dot(x, W, out=None):
+    """x W for float32, float16 and quantized W, in float32.
+
+    If given, the result is written to the float32 array `out`.
+    """
+    if out is None:
+        if isinstance(W, QuantizedMatrix):
+            return W.rdot(x)
+        return numpy.asarray(numpy.dot(x, W), dtype="float32")
+    if isinstance(W, QuantizedMatrix):
+        out[...] = W.rdot(x)
+    elif x.dtype == W.dtype == out.dtype and out.flags.c_contiguous:
+        numpy.dot(x, W, out=out)
+    else:
+        out[...] = numpy.dot(x, W)
+    return out
+
+def _lookup(state, prefix, key):
+    if '%s_%s' % (prefix, key) in state:
+        return state['%s_%s' % (prefix, key)]
+    return state[key]
+
+class NumpyEncoderDecoder(object):
+    """NumPy implementation of the decoding part of RNNEncoderDecoder.
+
+    The expected usage pattern is:
+    >>> enc_dec = NumpyEncoderDecoder(state)
+    >>> lm_model = enc_dec.create_lm_model()
+    >>> lm_model.load(path)
+    >>> beam_search = BeamSearch(enc_dec)
+    """
+
+    def __init__(self, state):
+        assert state['search'], "Only RNNsearch models are supported"
+        assert state['encoder_stack'] == 1 and state['decoder_stack'] == 1
+        assert _lookup(state, 'enc', 'rec_layer') == 'RecurrentLayer'
+        self.state = state
+        self.dim = state['dim']
+        self.params = {}
+        # One context matrix is carried between the beam search steps
+        self.current_contexts = [None]
+        self._buffers = {}
+
+        self.rank_n_activ = _activation(state['rank_n_activ'])
+        self.dec_activ = _activation(_lookup(state, 'dec', 'activ'))
+        self.dec_gater = _activation(_lookup(state, 'dec', 'rec_gater'))
+        self.dec_reseter = _activation(_lookup(state, 'dec', 'rec_reseter'))
+        self.unary_activ = (_activation(state['unary_activ'])
+                if state['deep_out'] else None)
+        self.softmax_name = 'dec_deep_softmax' if state['deep_out'] else 'dec_softmax'
+
+    def load(self, filename):
+        """Load the parameters saved by the Theano model or by quantize.py.
+
+        The float16 and quantized matrices are kept as they are
+        and dequantized when used.
+        """
+        vals = numpy.load(filename)
+        self.params = {}
+        for name in vals.keys():
+            if name.endswith(SCALES_SUFFIX):
+                continue
+            value = vals[name]
+            if name + SCALES_SUFFIX in vals:
+                value = QuantizedMatrix(value, vals[name + SCALES_SUFFIX])
+            self.params[name] = value
+        logger.debug("Loaded {} parameters from {}".format(len(self.params), filename))
+
+    def create_lm_model(self):
+        if not hasattr(self, 'lm_model'):
+            self.lm_model = NumpyLMModel(self)
+        return self.lm_model
+
+    def create_representation_computer(self):
+        return self.compute_representation
+
+    def create_initializers(self):
+        return self.compute_initial_states
+
+    def create_beam_step_computer(self, shortlist=False, alignment=False):
+        if alignment:
+            return functools.partial(self.beam_step, return_alignment=True)
+        return self.beam_step
+
+    def _buffer(self, name, shape):
+        """A preallocated array for temporary results, valid until the
+        next call with the same name.
+
+        The memory is only reallocated when a bigger array is needed,
+        not every time the number of beam elements changes.
+        """
+        size = int(numpy.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = numpy.empty(size, dtype="float32")
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def _dense(self, name, x, activation=None, buffer=None):
+        """The one layer MultiLayer called `name` applied to x.
+
+        Integer inputs select rows of the weight matrix. A bias that was
+        not learned is not saved and is zero. If `buffer` is given, the
+        result is computed in the preallocated array of that name.
+        """
+        W = self.params['W_0_' + name]
+        if x.dtype.kind in 'iu':
+            out = _rows(W, x)
+        elif buffer is not None:
+            out = _dot(x, W, self._buffer(buffer, x.shape[:-1] + W.shape[1:]))
+        else:
+            out = _dot(x, W)
+        b = self.params.get('b_0_' + name)
+        if b is not None:
+            out += b
+        if activation is not None:
+            out = activation(out)
+        return out
+
+    def _encode(self, prefix, emb):
+        """Run the gated recurrent layer of an encoder over the embeddings."""
+        activ = _activation(_lookup(self.state, prefix, 'activ'))
+        # The whole input contributions are computed at once
+        inputs = self._dense('{}_input_embdr_0'.format(prefix), emb)
+        gaters = resets = None
+        if _lookup(self.state, prefix, 'rec_gating'):
+            gater = _activation(_lookup(self.state, prefix, 'rec_gater'))
+            gaters = self._dense('{}_update_embdr_0'.format(prefix), emb)
+        if _lookup(self.state, prefix, 'rec_reseting'):
+            reseter = _activation(_lookup(self.state, prefix, 'rec_reseter'))
+            resets = self._dense('{}_reset_embdr_0'.format(prefix), emb)
+        name = '{}_transition_0'.format(prefix)
+        W_hh = self.params['W_' + name]
+
+        h = numpy.zeros(W_hh.shape[0], dtype="float32")
+        hidden = numpy.empty((len(emb), W_hh.shape[0]), dtype="float32")
+        for t in xrange(len(emb)):
+            reseted = h
+            if resets is not None:
+                reseted = reseter(_dot(h, self.params['R_' + name]) + resets[t]) * h
+            new_h = activ(_dot(reseted, W_hh) + inputs[t])
+            if gaters is not None:
+                z = gater(_dot(h, self.params['G_' + name]) + gaters[t])
+                new_h = z * new_h + (1 - z) * h
+            hidden[t] = h = new_h
+        return hidden
+
+    def compute_representation(self, seq):
+        """The annotations of a sentence and their attention projections."""
+        seq = numpy.asarray(seq)
+        emb = self._dense('enc_approx_embdr', seq, self.rank_n_activ)
+        forward = self._encode('enc', emb)
+        # The backward encoder uses the embeddings of the forward one
+        backward = self._encode('back_enc', emb[::-1])[::-1]
+        components = []
+        if self.state['forward']:
+            components.append(forward)
+        if self.state['last_forward']:
+            components.append(numpy.tile(forward[-1], (len(seq), 1)))
+        if self.state['backward']:
+            components.append(backward)
+        if self.state['last_backward']:
+            components.append(numpy.tile(backward[0], (len(seq), 1)))
+        c = numpy.hstack(components).astype("float32")
+        return [c, _dot(c, self.params['A_dec_transition_0'])]
+
+    def compute_initial_states(self, c):
+        init_c = c[0, -self.dim:]
+        if self.state['bias_code']:
+            return [self._dense('dec_initializer_0', init_c, self.dec_activ)]
+        return [numpy.zeros(self.dim, dtype="float32")]
+
+    def _update_states(self, y, emb, h, ctx):
+        """One step of the decoder recurrent layer with given contexts."""
+        name = 'dec_transition_0'
+        inputs = self._dense('dec_input_embdr_0', emb)
+        inputs += self._dense('dec_dec_inputter_0', ctx, buffer='term')
+        gaters = self._dense('dec_update_embdr_0', emb)
+        gaters += self._dense('dec_dec_updater_0', ctx, buffer='term')
+        resets = self._dense('dec_reset_embdr_0', emb)
+        resets += self._dense('dec_dec_reseter_0', ctx, buffer='term')
+        resets += _dot(h, self.params['R_' + name], self._buffer('term', h.shape))
+        reseted = self.dec_reseter(resets) * h
+        inputs += _dot(reseted, self.params['W_' + name], self._buffer('term', h.shape))
+        new_h = self.dec_activ(inputs)
+        gaters += _dot(h, self.params['G_' + name], self._buffer('term', h.shape))
+        z = self.dec_gater(gaters)
+        return (z * new_h + (1 - z) * h).astype("float32")
+
+    def _attend(self, c, c_mask, p_from_c, h):
+        """Weighted sums of the annotations and the attention weights,
+        c is (len, n, c_dim)."""
+        name = 'dec_transition_0'
+        p = self._buffer('p', p_from_c.shape)
+        numpy.add(p_from_c, _dot(h, self.params['B_' + name],
+            self._buffer('term', p_from_c.shape[1:]))[None], out=p)
+        numpy.tanh(p, out=p)
+        energy = _dot(p, self.params['D_' + name][:, 0],
+                self._buffer('energy', p.shape[:2]))
+        numpy.exp(energy, out=energy)
+        energy *= c_mask
+        probs = energy / energy.sum(axis=0)
+        return numpy.einsum('lnc,ln->nc', c, probs).astype("float32"), probs
+
+    def _next_probs(self, y, emb, h, ctx, shortlist=None):
+        readout = self._dense('dec_repr_readout', ctx, buffer='readout')
+        readout += self._dense('dec_hid_readout_0', h[:, :self.dim], buffer='term')
+        if self.state['bigram']:
+            check_first_word = ((y > 0) if self.state['check_first_word']
+                    else numpy.ones(len(y)))
+            prev_readout = self._dense('dec_prev_readout_0', emb)
+            prev_readout *= check_first_word[:, None]
+            readout += prev_readout
+        if self.unary_activ:
+            readout = self.unary_activ(readout)
+            if self.state['dropout'] < 1.:
+                readout *= self.state['dropout']
+
+        name = self.softmax_name
+        b = self.params['b_' + name]
+        if 'W1_' + name in self.params:
+            W = self.params['W2_' + name]
+            readout = _dot(readout, self.params['W1_' + name])
+        else:
+            W = self.params['W_' + name]
+        if shortlist is not None:
+            W = _columns(W, shortlist)
+            b = b[shortlist]
+        # The probabilities are returned, they are not kept in a buffer
+        energy = _dot(readout, W)
+        energy += b
+        energy -= energy.max(axis=1)[:, None]
+        numpy.exp(energy, out=energy)
+        energy /= energy.sum(axis=1)[:, None]
+        return energy
+
+    def beam_step(self, c, c_mask, p_from_c, origins, step_num, y, h, ctx,
+            shortlist=None, return_alignment=False):
+        """The fused beam search step, see create_beam_step_computer
+        of RNNEncoderDecoder."""
+        c = c[:, origins]
+        c_mask = c_mask[:, origins]
+        p_from_c = p_from_c[:, origins]
+        emb = self._dense('dec_approx_embdr', y, self.rank_n_activ)
+        if step_num > 0:
+            h = self._update_states(y, emb, h, ctx)
+        ctx, probs = self._attend(c, c_mask, p_from_c, h)
+        outputs = [self._next_probs(y, emb, h, ctx, shortlist), h, ctx]
+        if return_alignment:
+            outputs.append(probs.argmax(axis=0))
+        return outputs
+
+    def compute_cost(self, seq, trans):
+        """Negative log-probability of the translation `trans`
+        (ending with the end of sequence) of `seq`."""
+        c, p_from_c = self.compute_representation(seq)
+        h = self.compute_initial_states(c)[0][None]
+        ctx = numpy.zeros((1, c.shape[1]), dtype="float32")
+        c_mask = numpy.ones((len(c), 1), dtype="float32")
+        origins = numpy.zeros(1, dtype="int64")
+        y = numpy.zeros(1, dtype="int64")
+        cost = 0.
+        for k, word in enumerate(trans):
+            probs, h, ctx = self.beam_step(c[:, None], c_mask, p_from_c[:, None],
+                    origins, k, y, h, ctx)
+            cost -= numpy.log(probs[0, word])
+            y = numpy.array([word], dtype="int64")
+        return cost
+
+class NumpyLMModel(object):
+    """What the decoding scripts use of LM_Model: loading the
+    parameters and the target dictionary."""
+
+    def __init__(self, enc_dec):
+        self.enc_dec = enc_dec
+        state = enc_dec.state
+        self.word_indxs = cPickle.load(open(state['indx_word_target'], 'rb'))
+        self.word_indxs[state['null_sym_target']] = '<eol>'
+        self.word_indxs[state['unk_sym_target']] = state['oov']
+
+    def load(self, filename):
+        self.enc_dec.load(filename)
@@ -0,0 +1,103 @@
+"""A cache of the translations of source phrases.
+
+segment.py translates every subphrase of every sentence and the same
+short phrases come up again and again in a corpus. PhraseCache keeps
+the best translations of the recently translated phrases across the
+sentences and, if it is given a path, across the runs.
+"""
+
+import collections
+import cPickle
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def model_identity(lm_model, state):
+    """A digest of the parameters and the state of a model.
+
+    The translations of a model are only reused for the same model.
+    """
+    digest = hashlib.md5(repr(sorted(state.items())))
+    for param in sorted(lm_model.params, key=lambda p: p.name):
+        digest.update(param.name)
+        digest.update(param.get_value(borrow=True).tostring())
+    return digest.hexdigest()
+
+class PhraseCache(object):
+    """An LRU cache of (sentences, costs, trans) keyed by the model, the
+    beam size and the word indices of the phrase.
+
+    Only the `top_k` best translations of a phrase are kept. At most
+    `max_entries` phrases are kept, the least recently used ones are
+    evicted first. If `path` is given the cache is loaded from it and
+    saved to it by `save`.
+
+    The numbers of hits and misses are kept in `hits` and `misses`.
+    """
+
+    def __init__(self, model_id, max_entries, top_k=10, path=None):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.top_k = top_k
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'rb') as src:
+                entries = cPickle.load(src)
+            for key, value in entries:
+                if key[0] == model_id:
+                    self.entries[key] = value
+            self._evict()
+            logger.debug("Loaded {} of the {} cached phrases from {}".format(
+                len(self.entries), len(entries), path))
+
+    def key(self, phrase, n_samples):
+        return (self.model_id, n_samples, tuple(int(word) for word in phrase))
+
+    def get(self, phrase, n_samples):
+        """The cached translations of the phrase or None."""
+        key = self.key(phrase, n_samples)
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+
+    def put(self, phrase, n_samples, value):
+        """Cache the (sentences, costs, trans) of the phrase and return
+        the part of it that is kept."""
+        sentences, costs, trans = value
+        # The order by cost and sentence is the one segment.py selects by
+        order = sorted(range(len(costs)),
+                key=lambda i: (costs[i], sentences[i]))[:self.top_k]
+        value = ([sentences[i] for i in order], [costs[i] for i in order],
+                [trans[i] for i in order])
+        self.entries[self.key(phrase, n_samples)] = value
+        self._evict()
+        return value
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                entries=len(self.entries),
+                hit_rate=float(self.hits) / max(requests, 1))
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", 'wb') as dst:
+            cPickle.dump(self.entries.items(), dst,
+                    protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.path + ".tmp", self.path)
+        logger.debug("Saved {} cached phrases to {}".format(
+            len(self.entries), self.path))
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
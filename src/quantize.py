@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Quantize the parameters of a model for decoding with --numpy.
+
+The matrices are stored either as float16 or as int8 with a float32
+scale per row. numpy_encdec dequantizes them when they are used, so
+the decoder keeps the compact matrices in memory.
+"""
+
+import argparse
+import cPickle
+import logging
+import itertools
+import time
+import os
+
+import numpy
+
+from analysis import bleu_stats, bleu
+from encdec import parse_input
+from numpy_encdec import NumpyEncoderDecoder, SCALES_SUFFIX
+from sample import BeamSearch
+from state import prototype_state
+
+logger = logging.getLogger(__name__)
+
+def quantize_int8(W):
+    """Quantize a matrix to int8 with a scale per row."""
+    scales = numpy.abs(W).max(axis=1) / 127.
+    scales[scales == 0] = 1.
+    values = numpy.round(W / scales[:, None]).astype("int8")
+    return values, scales.astype("float32")
+
+def quantize(params, mode, min_size):
+    """Quantize the matrices with at least `min_size` elements.
+
+    Returns the arrays to save, the others are kept as they are.
+    """
+    result = {}
+    for name, value in params.items():
+        if value.ndim != 2 or min(value.shape) == 1 or value.size < min_size:
+            result[name] = value
+        elif mode == "float16":
+            result[name] = value.astype("float16")
+        else:
+            result[name], result[name + SCALES_SUFFIX] = quantize_int8(value)
+        logger.debug("{} {}: {}".format(name, value.shape, result[name].dtype))
+    return result
+
+def translate(enc_dec, seqs, beam_size):
+    """Best translations and the time they took."""
+    beam_search = BeamSearch(enc_dec)
+    beam_search.compile()
+    start_time = time.time()
+    best = []
+    for seq in seqs:
+        trans, costs = beam_search.search(seq, beam_size, minlen=len(seq) / 2)
+        best.append(trans[numpy.argmin(costs)] if len(trans) else [0])
+    return best, time.time() - start_time
+
+def report(state, model_path, quantized_path, source, beam_size,
+        n_sentences, trans_prefix=None):
+    """Compare the translations of the original and the quantized model.
+
+    Prints the decoding speeds, the share of identical translations,
+    the BLEU of the quantized translations against the original ones and
+    how much worse the quantized translations are according to the
+    original model.
+    """
+    indx_word = cPickle.load(open(state['word_indx'], 'rb'))
+    with open(source) as src:
+        seqs = [parse_input(state, indx_word, line.strip())[0]
+                for line in itertools.islice(src, n_sentences)]
+
+    original = NumpyEncoderDecoder(state)
+    original.create_lm_model().load(model_path)
+    quantized = NumpyEncoderDecoder(state)
+    quantized.create_lm_model().load(quantized_path)
+
+    orig_trans, orig_time = translate(original, seqs, beam_size)
+    quant_trans, quant_time = translate(quantized, seqs, beam_size)
+    cost_deltas = [original.compute_cost(seq, q) - original.compute_cost(seq, o)
+            for seq, o, q in zip(seqs, orig_trans, quant_trans)]
+    stats = [list(bleu_stats(list(q), list(o)))
+            for o, q in zip(orig_trans, quant_trans)]
+
+    print "Model size: {} -> {} bytes".format(
+            os.path.getsize(model_path), os.path.getsize(quantized_path))
+    print "Time per sentence: {:.4f} -> {:.4f} s".format(
+            orig_time / len(seqs), quant_time / len(seqs))
+    print "Identical translations: {:.1f}%".format(100. * numpy.mean(
+        [list(o) == list(q) for o, q in zip(orig_trans, quant_trans)]))
+    print "BLEU against the original translations: {:.2f}".format(bleu(stats))
+    print "Mean cost increase under the original model: {:.4f}".format(
+            numpy.mean(cost_deltas))
+
+    if trans_prefix:
+        # For scoring with score.py
+        word_indxs = original.create_lm_model().word_indxs
+        for suffix, all_trans in [("orig", orig_trans), ("quant", quant_trans)]:
+            with open("{}.{}".format(trans_prefix, suffix), "w") as dst:
+                for trans in all_trans:
+                    print >>dst, " ".join(word_indxs[w] for w in trans[:-1])
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Quantize a model for decoding with the NumPy implementation")
+    parser.add_argument("--mode",
+            default="int8", choices=["int8", "float16"],
+            help="int8 with a scale per row, or float16")
+    parser.add_argument("--min-size",
+            type=int, default=10000,
+            help="Only the matrices with at least this many elements are quantized")
+    parser.add_argument("--state",
+            help="State of the model, needed for the report")
+    parser.add_argument("--source",
+            help="Source sentences to compare the translations of"
+                " the original and the quantized model on")
+    parser.add_argument("--n-sentences",
+            type=int, default=100,
+            help="Number of source sentences used for the report")
+    parser.add_argument("--beam-size",
+            type=int, default=12,
+            help="Beam size for the report")
+    parser.add_argument("--trans-prefix",
+            help="Save both translations of the report as PREFIX.orig and"
+                " PREFIX.quant, e.g. to score them with score.py")
+    parser.add_argument("model_path",
+            help="Path to the model")
+    parser.add_argument("quantized_path",
+            help="Where to save the quantized model")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG,
+            format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    params = dict(numpy.load(args.model_path))
+    with open(args.quantized_path, "wb") as dst:
+        numpy.savez(dst, **quantize(params, args.mode, args.min_size))
+
+    if args.source:
+        assert args.state
+        state = prototype_state()
+        with open(args.state) as src:
+            state.update(cPickle.load(src))
+        state.update(eval("dict({})".format(args.changes)))
+        report(state, args.model_path, args.quantized_path, args.source,
+                args.beam_size, args.n_sentences, args.trans_prefix)
+
+if __name__ == "__main__":
+    main()
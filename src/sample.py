@@ -6,6 +6,11 @@ import traceback
 import logging
 import time
 import sys
+import itertools
+import multiprocessing
+import collections
+import contextlib
+import json
 
 import numpy
 
@@ -18,6 +23,11 @@ from state import\
     prototype_encdec_state,\
     prototype_search_state
 from numpy_compat import argpartition
+from shortlist import Shortlist, load_candidates
+from numpy_encdec import NumpyEncoderDecoder
+from nbest import NBestWriter
+from unkpos import Replacer, load_dictionary
+from encoder_cache import EncoderCache
 
 logger = logging.getLogger(__name__)
 
@@ -32,109 +42,524 @@ class Timer(object):
     def finish(self):
         self.total += time.time() - self.start_time
 
+@contextlib.contextmanager
+def _untimed():
+    yield
+
+class Profiler(object):
+    """Wall time of the phases of decoding and per sentence statistics.
+
+    The next word probabilities and the next states are computed by one
+    fused call, timed as the "step" phase.
+    """
+
+    PHASES = ['parse_input', 'encode', 'step', 'top_k', 'reorder',
+            'backtrack', 'detokenize']
+
+    def __init__(self, trace_path=None):
+        self.timers = collections.OrderedDict(
+                (phase, Timer()) for phase in self.PHASES)
+        self.trace = open(trace_path, "w") if trace_path else None
+        self.n_sentences = 0
+        self.n_steps = 0
+        self.occupancy = 0.
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        timer = self.timers[name]
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.finish()
+
+    def add_sentences(self, stats, sentence_ids=None):
+        """Record the statistics of searched sentences, see BeamSearch.last_stats.
+
+        The trace records of the sentences are identified by `sentence_ids`,
+        by their order of arrival if it is not given.
+        """
+        if sentence_ids is None:
+            sentence_ids = range(self.n_sentences, self.n_sentences + len(stats))
+        for sentence_id, sentence_stats in zip(sentence_ids, stats):
+            self.n_sentences += 1
+            self.n_steps += sentence_stats['steps']
+            self.occupancy += sentence_stats['occupancy']
+            if self.trace:
+                record = dict(
+                    (key, value.item() if isinstance(value, numpy.generic) else value)
+                    for key, value in sentence_stats.items())
+                record['sentence'] = int(sentence_id)
+                print >>self.trace, json.dumps(record)
+
+    def summary(self):
+        total = sum(timer.total for timer in self.timers.values())
+        summary = collections.OrderedDict()
+        for phase, timer in self.timers.items():
+            summary[phase] = timer.total
+            summary[phase + '_share'] = timer.total / total if total else 0.
+        summary['sentences'] = self.n_sentences
+        summary['steps'] = self.n_steps
+        summary['mean_occupancy'] = self.occupancy / max(self.n_sentences, 1)
+        return summary
+
+    def save(self, path):
+        """Write the summary as CSV if `path` ends with .csv, as JSON otherwise."""
+        summary = self.summary()
+        with open(path, "w") as dst:
+            if path.endswith(".csv"):
+                print >>dst, "key,value"
+                for key, value in summary.items():
+                    print >>dst, "{},{}".format(key, value)
+            else:
+                json.dump(summary, dst, indent=2)
+        if self.trace:
+            self.trace.close()
+
 class BeamSearch(object):
 
-    def __init__(self, enc_dec):
+    def __init__(self, enc_dec, extra_steps_factor=1., time_budget=None,
+            early_stop=False, rel_threshold=None, abs_threshold=None,
+            max_per_parent=None, shortlist=None, return_alignment=False,
+            batch_encoder=False, encoder_cache=None, profiler=None):
+        """
+        :param extra_steps_factor:
+            a sentence without any finished translation after 3 * len(seq)
+            steps is decoded for extra_steps_factor * len(seq) more steps
+            with UNK allowed, even if some of its hypotheses end meanwhile.
+            Then all its live hypotheses are forced to end.
+
+        :param time_budget:
+            if given, the maximum number of seconds for one search; when it
+            is exceeded all the hypotheses are ended at the current step
+
+        :param early_stop:
+            drop the live hypotheses that already cost at least as much as
+            the best finished translation of their sentence. As costs only
+            grow, they can not beat it any more. The best translation stays
+            the same unless the costs are normalized afterwards, but fewer
+            worse ones are found.
+
+        :param rel_threshold:
+            drop the candidates that cost more than (1 + rel_threshold)
+            times the best candidate of their sentence at the same step
+
+        :param abs_threshold:
+            drop the candidates that cost more than the best candidate
+            of their sentence at the same step plus abs_threshold
+
+        :param max_per_parent:
+            the maximum number of candidates extending one hypothesis
+
+        :param shortlist:
+            if given, a function returning the sorted target words allowed
+            for a list of source sequences (see shortlist.Shortlist). The
+            probabilities are computed only for these words, every sentence
+            of a batch gets only the words of its own shortlist.
+
+        :param return_alignment:
+            keep for every target word of every translation the source
+            position the attention was the highest at when the word was
+            chosen (RNNsearch only). They are left in `last_alignments`,
+            like the log-probabilities in `last_log_probs`.
+
+        :param batch_encoder:
+            encode all the sentences of a search by one call, see
+            create_batch_representation_computer of RNNEncoderDecoder
+
+        :param encoder_cache:
+            if given, an EncoderCache (see encoder_cache.py) for the
+            annotations and the initial states of the source sentences,
+            not used with batch_encoder
+
+        :param profiler:
+            if given, a Profiler the time of the phases of the search and
+            the statistics of the sentences are added to
+
+        The statistics of the last search are kept in `last_stats`,
+        a dictionary per sentence.
+        """
         self.enc_dec = enc_dec
         state = self.enc_dec.state
         self.eos_id = state['null_sym_target']
         self.unk_id = state['unk_sym_target']
+        self.extra_steps_factor = extra_steps_factor
+        self.time_budget = time_budget
+        self.early_stop = early_stop
+        self.rel_threshold = rel_threshold
+        self.abs_threshold = abs_threshold
+        self.max_per_parent = max_per_parent
+        self.shortlist = shortlist
+        self.return_alignment = return_alignment
+        self.batch_encoder = batch_encoder
+        self.encoder_cache = encoder_cache
+        self.profiler = profiler
+        self.last_stats = []
+        self.last_log_probs = []
+        self.last_alignments = []
 
     def compile(self):
-        self.comp_repr = self.enc_dec.create_representation_computer()
-        self.comp_init_states = self.enc_dec.create_initializers()
-        self.comp_next_probs = self.enc_dec.create_next_probs_computer()
-        self.comp_next_states = self.enc_dec.create_next_states_computer()
+        if self.batch_encoder:
+            self.comp_batch_repr = self.enc_dec.create_batch_representation_computer()
+        else:
+            self.comp_repr = self.enc_dec.create_representation_computer()
+            self.comp_init_states = self.enc_dec.create_initializers()
+        self.comp_step = self.enc_dec.create_beam_step_computer(
+                shortlist=self.shortlist is not None,
+                alignment=self.return_alignment)
 
     def search(self, seq, n_samples, ignore_unk=False, minlen=1):
-        c = self.comp_repr(seq)[0]
-        states = map(lambda x : x[None, :], self.comp_init_states(c))
-        dim = states[0].shape[1]
+        return self.search_batch([seq], n_samples, ignore_unk, [minlen])[0]
+
+    def search_batch(self, seqs, n_samples, ignore_unk=False, minlens=None,
+            sentence_ids=None):
+        """Beam search for several source sentences at once.
 
-        num_levels = len(states)
+        The beams of all the sentences are stacked into one matrix of
+        decoder states, so that every step is a single call of the
+        compiled functions. `origins` tells for every row which
+        sentence it belongs to, `offsets` where each sentence's rows start.
 
-        fin_trans = []
+        Returns a list of (fin_trans, fin_costs) pairs in the order of `seqs`.
+        The log-probabilities of the words of every translation are
+        left in `last_log_probs`. `sentence_ids` identify the sentences
+        in the trace of the profiler.
+        """
+        if minlens is None:
+            minlens = [1] * len(seqs)
+        results = self._search(seqs, n_samples, ignore_unk, minlens)
+        for (fin_trans, fin_costs), stats in zip(results, self.last_stats):
+            if not len(fin_trans):
+                logger.error("Translation failed")
+            logger.debug("Search statistics: {}".format(stats))
+        if self.encoder_cache is not None:
+            logger.debug("Encoder cache: {}".format(self.encoder_cache.stats()))
+        if self.profiler:
+            self.profiler.add_sentences(self.last_stats, sentence_ids)
+        return results
+
+    def _search(self, seqs, n_samples, ignore_unk, minlens):
+        n_seqs = len(seqs)
+        minlens = numpy.asarray(minlens)
+        lens = numpy.array(map(len, seqs))
+        max_steps = 3 * lens
+        extra_steps = numpy.ceil(self.extra_steps_factor * lens).astype("int64")
+        start_time = time.time()
+        timed = self.profiler.phase if self.profiler else lambda name: _untimed()
+
+        # The annotations, their mask and the attention projections
+        # of the annotations, all padded to the same length,
+        # followed by the decoder states.
+        with timed('encode'):
+            if self.batch_encoder:
+                x, c_mask = pack_sequences(seqs)
+                c, projections, carry = self.comp_batch_repr(x, c_mask)
+                source = [c, c_mask] + projections
+                carry = list(carry)
+            else:
+                if self.encoder_cache is not None:
+                    encoded = [self.encoder_cache.get(seq, self._encode) for seq in seqs]
+                else:
+                    encoded = map(self._encode, seqs)
+                reprs = [r for r, states in encoded]
+                c, c_mask = pack_annotations([r[0] for r in reprs])
+                source = [c, c_mask] + [pack_annotations(projections)[0]
+                        for projections in zip(*reprs)[1:]]
+                carry = [numpy.vstack(level_states) for level_states in
+                        zip(*[states for r, states in encoded])]
+
+        # and by the contexts of the previous step
+        carry += [numpy.zeros((n_seqs, c.shape[2]), dtype="float32")
+                for ctx in self.enc_dec.current_contexts]
+
+        # With a shortlist the columns of the probabilities are
+        # the shortlisted words, not the whole vocabulary. The
+        # probabilities are computed for the words of all the sentences,
+        # those of every sentence are then restricted to its own words.
+        vocab = None
+        sent_words = None
+        eos_col, unk_col = self.eos_id, self.unk_id
+        shortlist_args = []
+        if self.shortlist is not None:
+            vocab = self.shortlist(seqs)
+            if n_seqs > 1:
+                sent_words = numpy.zeros((n_seqs, len(vocab)), dtype="bool")
+                for i, seq in enumerate(seqs):
+                    sent_words[i, numpy.searchsorted(vocab, self.shortlist(seq))] = True
+            eos_col = numpy.searchsorted(vocab, self.eos_id)
+            assert vocab[eos_col] == self.eos_id
+            unk_col = (vocab == self.unk_id).nonzero()[0]
+            unk_col = unk_col[0] if len(unk_col) else None
+            shortlist_args = [vocab]
+
+        # The beams are kept in preallocated arrays: for every step and
+        # every candidate, the chosen word, its cost so far and the
+        # position of its parent among the candidates of the previous step.
+        width = n_seqs * n_samples
+        total_steps = (max_steps + extra_steps).max()
+        words = numpy.zeros((total_steps, width), dtype="int64")
+        step_costs = numpy.zeros((total_steps, width))
+        attended = (numpy.zeros((total_steps, width), dtype="int64")
+                if self.return_alignment else None)
+        back_pointers = numpy.zeros((total_steps, width), dtype="int64")
+        beam_sizes = numpy.zeros(n_seqs, dtype="int64") + n_samples
+
+        # Live hypotheses: their costs, sentences and positions
+        # among the candidates of the last step.
+        costs = numpy.zeros(n_seqs)
+        origins = numpy.arange(n_seqs)
+        positions = numpy.zeros(n_seqs, dtype="int64")
+
+        # Finished hypotheses: where they end and what they cost.
+        fin_steps = []
+        fin_positions = []
+        fin_origins = []
         fin_costs = []
+        best_fin_costs = numpy.zeros(n_seqs) + numpy.inf
+
+        # Per sentence statistics
+        n_steps = numpy.zeros(n_seqs, dtype="int64")
+        n_pruned = numpy.zeros(n_seqs, dtype="int64")
+        n_bounded = numpy.zeros(n_seqs, dtype="int64")
+        n_forced = numpy.zeros(n_seqs, dtype="int64")
+        n_live = numpy.zeros(n_seqs, dtype="int64")
 
-        trans = [[]]
-        costs = [0.0]
+        # Number of steps each sentence may be decoded for. The sentences
+        # without any finished translation at their last step get extra
+        # steps once, at the end of which all their hypotheses must end.
+        step_limits = max_steps.copy()
+        extended = numpy.zeros(n_seqs, dtype="bool")
 
-        for k in range(3 * len(seq)):
-            if n_samples == 0:
+        for k in range(total_steps):
+            if not len(origins):
                 break
+            n_live += numpy.bincount(origins, minlength=n_seqs)
 
-            # Compute probabilities of the next words for
-            # all the elements of the beam.
-            beam_size = len(trans)
-            last_words = (numpy.array(map(lambda t : t[-1], trans))
-                    if k > 0
-                    else numpy.zeros(beam_size, dtype="int64"))
-            log_probs = numpy.log(self.comp_next_probs(c, k, last_words, *states)[0])
-
-            # Adjust log probs according to search restrictions
-            if ignore_unk:
-                log_probs[:,self.unk_id] = -numpy.inf
-            # TODO: report me in the paper!!!
-            if k < minlen:
-                log_probs[:,self.eos_id] = -numpy.inf
-
-            # Find the best options by calling argpartition of flatten array
-            next_costs = numpy.array(costs)[:, None] - log_probs
-            flat_next_costs = next_costs.flatten()
-            best_costs_indices = argpartition(
-                    flat_next_costs.flatten(),
-                    n_samples)[:n_samples]
-
-            # Decypher flatten indices
-            voc_size = log_probs.shape[1]
-            trans_indices = best_costs_indices / voc_size
-            word_indices = best_costs_indices % voc_size
-            costs = flat_next_costs[best_costs_indices]
-
-            # Form a beam for the next iteration
-            new_trans = [[]] * n_samples
-            new_costs = numpy.zeros(n_samples)
-            new_states = [numpy.zeros((n_samples, dim), dtype="float32") for level
-                    in range(num_levels)]
-            inputs = numpy.zeros(n_samples, dtype="int64")
-            for i, (orig_idx, next_word, next_cost) in enumerate(
-                    zip(trans_indices, word_indices, costs)):
-                new_trans[i] = trans[orig_idx] + [next_word]
-                new_costs[i] = next_cost
-                for level in range(num_levels):
-                    new_states[level][i] = states[level][orig_idx]
-                inputs[i] = next_word
-            new_states = self.comp_next_states(c, k, inputs, *new_states)
-
-            # Filter the sequences that end with end-of-sequence character
-            trans = []
-            costs = []
-            indices = []
-            for i in range(n_samples):
-                if new_trans[i][-1] != self.enc_dec.state['null_sym_target']:
-                    trans.append(new_trans[i])
-                    costs.append(new_costs[i])
-                    indices.append(i)
-                else:
-                    n_samples -= 1
-                    fin_trans.append(new_trans[i])
-                    fin_costs.append(new_costs[i])
-            states = map(lambda x : x[indices], new_states)
-
-        # Dirty tricks to obtain any translation
-        if not len(fin_trans):
-            if ignore_unk:
-                logger.warning("Did not manage without UNK")
-                return self.search(seq, n_samples, False, minlen)
-            elif n_samples < 500:
-                logger.warning("Still no translations: try beam size {}".format(n_samples * 2))
-                return self.search(seq, n_samples * 2, False, minlen)
+            out_of_time = (self.time_budget is not None
+                    and time.time() - start_time > self.time_budget)
+            if out_of_time:
+                logger.warning("Out of time budget, ending the search at step {}".format(k))
+                step_limits = numpy.minimum(step_limits, k + 1)
             else:
-                logger.error("Translation failed")
+                extend = (~extended & (beam_sizes == n_samples)
+                        & (step_limits == k + 1) & (extra_steps > 0))
+                step_limits[extend] += extra_steps[extend]
+                extended |= extend
+
+            # Consume the last chosen words and compute probabilities
+            # of the next words for all the elements of all the beams.
+            last_words = (words[k - 1, positions]
+                    if k > 0
+                    else numpy.zeros(len(origins), dtype="int64"))
+            with timed('step'):
+                outputs = self.comp_step(*(source + [origins, k, last_words]
+                    + carry + shortlist_args))
+            if self.return_alignment:
+                step_attended = outputs[-1]
+                outputs = outputs[:-1]
+            probs = outputs[0]
+            if sent_words is not None:
+                probs = probs * sent_words[origins]
+                probs /= probs.sum(axis=1)[:, None]
+            with numpy.errstate(divide='ignore'):
+                log_probs = numpy.log(probs)
+            carry = outputs[1:]
+
+            with timed('top_k'):
+                # Adjust log probs according to search restrictions
+                eos_log_probs = log_probs[:, eos_col].copy()
+                if ignore_unk and unk_col is not None:
+                    log_probs[max_steps[origins] > k, unk_col] = -numpy.inf
+                # TODO: report me in the paper!!!
+                log_probs[minlens[origins] > k, eos_col] = -numpy.inf
+
+                # The hypotheses of the sentences without any translation
+                # or with extra steps can only end at their last step.
+                forced = (((beam_sizes[origins] == n_samples) | extended[origins])
+                        & (step_limits[origins] == k + 1)).nonzero()[0]
+                if len(forced):
+                    log_probs[forced] = -numpy.inf
+                    log_probs[forced, eos_col] = eos_log_probs[forced]
+                    n_forced += numpy.bincount(origins[forced], minlength=n_seqs)
+
+                # Only the best words of every hypothesis are candidates
+                # if their number is limited.
+                cand_words = None
+                if self.max_per_parent and self.max_per_parent < log_probs.shape[1]:
+                    cand_words = argpartition(-log_probs,
+                            self.max_per_parent - 1, axis=1)[:, :self.max_per_parent]
+                    log_probs = log_probs[
+                            numpy.arange(len(origins))[:, None], cand_words]
+
+                # Lay the costs out as (sentence, beam element, candidate) and
+                # find the best options for all sentences by one argpartition.
+                n_cands_per_row = log_probs.shape[1]
+                active = numpy.unique(origins)
+                offsets = numpy.searchsorted(origins, active)
+                sent_indices = numpy.searchsorted(active, origins)
+                next_costs = numpy.empty((len(active), n_samples, n_cands_per_row))
+                next_costs.fill(numpy.inf)
+                next_costs[sent_indices,
+                        numpy.arange(len(origins)) - offsets[sent_indices]] = \
+                            costs[:, None] - log_probs
+                next_costs = next_costs.reshape((len(active), -1))
+                best_costs_indices = argpartition(
+                        next_costs, n_samples - 1, axis=1)[:, :n_samples]
+                best_costs = next_costs[
+                        numpy.arange(len(active))[:, None], best_costs_indices]
+                order = numpy.argsort(best_costs, axis=1)
+                best_costs_indices = best_costs_indices[
+                        numpy.arange(len(active))[:, None], order]
+                best_costs = best_costs[numpy.arange(len(active))[:, None], order]
+
+                # Each sentence keeps as many options as it has beam left
+                taken = ((numpy.arange(n_samples)[None, :] < beam_sizes[active][:, None])
+                        & numpy.isfinite(best_costs))
+                # and drops the ones too far from its best one
+                allowed = taken.copy()
+                if self.rel_threshold is not None:
+                    allowed &= best_costs <= best_costs[:, :1] * (1 + self.rel_threshold)
+                if self.abs_threshold is not None:
+                    allowed &= best_costs <= best_costs[:, :1] + self.abs_threshold
+                n_pruned[active] += (taken & ~allowed).sum(axis=1)
+                taken = allowed
+                n_steps[active] = k + 1
+
+                new_sent_indices = taken.nonzero()[0]
+                best_costs_indices = best_costs_indices[taken]
+                trans_indices = offsets[new_sent_indices] + best_costs_indices / n_cands_per_row
+                word_indices = best_costs_indices % n_cands_per_row
+                if cand_words is not None:
+                    word_indices = cand_words[trans_indices, word_indices]
+                if vocab is not None:
+                    word_indices = vocab[word_indices]
+                costs = best_costs[taken]
+                origins = active[new_sent_indices]
+
+            # Record the candidates
+            n_cands = len(word_indices)
+            words[k, :n_cands] = word_indices
+            step_costs[k, :n_cands] = costs
+            if self.return_alignment:
+                attended[k, :n_cands] = step_attended[trans_indices]
+            back_pointers[k, :n_cands] = positions[trans_indices]
 
-        fin_trans = numpy.array(fin_trans)[numpy.argsort(fin_costs)]
-        fin_costs = numpy.array(sorted(fin_costs))
-        return fin_trans, fin_costs
+            # Move the sequences that end with end-of-sequence character
+            # to the finished ones.
+            finished = word_indices == self.eos_id
+            if finished.any():
+                fin_steps.append(numpy.zeros(finished.sum(), dtype="int64") + k)
+                fin_positions.append(finished.nonzero()[0])
+                fin_origins.append(origins[finished])
+                fin_costs.append(costs[finished])
+                beam_sizes -= numpy.bincount(origins[finished], minlength=n_seqs)
+                numpy.minimum.at(best_fin_costs, origins[finished], costs[finished])
+            live = ~finished & (step_limits[origins] > k + 1)
+            if self.early_stop:
+                hopeless = live & (costs >= best_fin_costs[origins])
+                n_bounded += numpy.bincount(origins[hopeless], minlength=n_seqs)
+                live &= ~hopeless
+            live = live.nonzero()[0]
+
+            # Form the beams for the next iteration
+            costs = costs[live]
+            origins = origins[live]
+            positions = live
+            with timed('reorder'):
+                carry = self.reorder(carry, trans_indices[live])
+
+        self.last_stats = [dict(steps=n_steps[i], max_steps=max_steps[i],
+                pruned=n_pruned[i], bounded=n_bounded[i], forced=n_forced[i],
+                occupancy=float(n_live[i]) / max(n_steps[i] * n_samples, 1),
+                vocab=len(vocab) if vocab is not None else None,
+                time=time.time() - start_time)
+            for i in range(n_seqs)]
+        with timed('backtrack'):
+            return self._collect(n_seqs, words, step_costs, attended,
+                    back_pointers, fin_steps, fin_positions, fin_origins, fin_costs)
+
+    def _encode(self, seq):
+        """The annotations (and projections) and the initial states of `seq`."""
+        reprs = self.comp_repr(seq)
+        return [reprs, self.comp_init_states(reprs[0])]
+
+    def reorder(self, carry, indices):
+        """Select the states (and contexts) of the given beam elements."""
+        return [x[indices] for x in carry]
+
+    def _collect(self, n_seqs, words, step_costs, attended, back_pointers,
+            fin_steps, fin_positions, fin_origins, fin_costs):
+        """Reconstruct the finished hypotheses by backtracking."""
+        results = [([], []) for i in range(n_seqs)]
+        self.last_log_probs = [[] for i in range(n_seqs)]
+        self.last_alignments = [[] for i in range(n_seqs)]
+        if not fin_steps:
+            return results
+        fin_steps = numpy.hstack(fin_steps)
+        fin_positions = numpy.hstack(fin_positions)
+        fin_origins = numpy.hstack(fin_origins)
+        fin_costs = numpy.hstack(fin_costs)
+
+        # Hypotheses that end at the same step are traced back together
+        fin_trans = [None] * len(fin_steps)
+        fin_log_probs = [None] * len(fin_steps)
+        fin_alignments = [None] * len(fin_steps)
+        for step in numpy.unique(fin_steps):
+            indices = (fin_steps == step).nonzero()[0]
+            trans = numpy.zeros((len(indices), step + 1), dtype="int64")
+            trans_costs = numpy.zeros((len(indices), step + 2))
+            alignments = numpy.zeros((len(indices), step + 1), dtype="int64")
+            positions = fin_positions[indices]
+            for k in range(step, -1, -1):
+                trans[:, k] = words[k, positions]
+                trans_costs[:, k + 1] = step_costs[k, positions]
+                if attended is not None:
+                    alignments[:, k] = attended[k, positions]
+                positions = back_pointers[k, positions]
+            log_probs = -numpy.diff(trans_costs, axis=1)
+            for i, idx in enumerate(indices):
+                fin_trans[idx] = trans[i]
+                fin_log_probs[idx] = log_probs[i]
+                fin_alignments[idx] = alignments[i]
+
+        for i in range(n_seqs):
+            indices = (fin_origins == i).nonzero()[0]
+            indices = indices[numpy.argsort(fin_costs[indices])]
+            results[i] = (numpy.array([fin_trans[idx] for idx in indices]),
+                    fin_costs[indices])
+            self.last_log_probs[i] = [fin_log_probs[idx] for idx in indices]
+            if attended is not None:
+                self.last_alignments[i] = [fin_alignments[idx] for idx in indices]
+        return results
+
+def pack_sequences(seqs):
+    """Pad sequences of word indices into a (max_seq_len, n_seqs) matrix
+    and its 0/1 mask, like the training batches."""
+    x = numpy.zeros((max(map(len, seqs)), len(seqs)), dtype="int64")
+    x_mask = numpy.zeros(x.shape, dtype="float32")
+    for i, seq in enumerate(seqs):
+        x[:len(seq), i] = seq
+        x_mask[:len(seq), i] = 1.
+    return x, x_mask
+
+def pack_annotations(reprs):
+    """Pad annotations of several sentences into one tensor.
+
+    Padding repeats the last annotation, like PadLayer does, so that
+    models without attention still find a meaningful vector there.
+    Works the same for the projections of the annotations.
+
+    :returns: (c, c_mask) of shapes (max_seq_len, n_sentences, c_dim)
+        and (max_seq_len, n_sentences)
+    """
+    max_len = max(map(len, reprs))
+    c = numpy.zeros((max_len, len(reprs), reprs[0].shape[1]), dtype="float32")
+    c_mask = numpy.zeros((max_len, len(reprs)), dtype="float32")
+    for i, r in enumerate(reprs):
+        c[:len(r), i] = r
+        c[len(r):, i] = r[-1]
+        c_mask[:len(r), i] = 1.
+    return c, c_mask
 
 def indices_to_words(i2w, seq):
     sen = []
@@ -163,34 +588,129 @@ def sample(lm_model, seq, n_samples,
                 print "{}: {}".format(costs[i], sentences[i])
         return sentences, costs, trans
     elif sampler:
-        sentences = []
-        all_probs = []
-        costs = []
-
         values, cond_probs = sampler(n_samples, 3 * (len(seq) - 1), alpha, seq)
-        for sidx in xrange(n_samples):
-            sen = []
-            for k in xrange(values.shape[0]):
-                if lm_model.word_indxs[values[k, sidx]] == '<eol>':
-                    break
-                sen.append(lm_model.word_indxs[values[k, sidx]])
-            sentences.append(" ".join(sen))
-            probs = cond_probs[:, sidx]
-            probs = numpy.array(cond_probs[:len(sen) + 1, sidx])
-            all_probs.append(numpy.exp(-probs))
-            costs.append(-numpy.sum(probs))
-        if normalize:
-            counts = [len(s.strip().split(" ")) for s in sentences]
-            costs = [co / cn for co, cn in zip(costs, counts)]
+        sentences, costs = cut_samples(lm_model, values, cond_probs, normalize)
         sprobs = numpy.argsort(costs)
         if verbose:
             for pidx in sprobs:
-                print "{}: {} {} {}".format(pidx, -costs[pidx], all_probs[pidx], sentences[pidx])
+                print "{}: {} {}".format(pidx, costs[pidx], sentences[pidx])
             print
         return sentences, costs, None
     else:
         raise Exception("I don't know what to do")
 
+def sample_batch(lm_model, seqs, n_samples, beam_search,
+        ignore_unk=False, normalize=False, sentence_ids=None):
+    """Batched version of sample for beam search.
+
+    Returns a list of (sentences, costs, trans) triples in the order of `seqs`.
+    """
+    results = []
+    timed = (beam_search.profiler.phase if beam_search.profiler
+            else lambda name: _untimed())
+    for trans, costs in beam_search.search_batch(seqs, n_samples,
+            ignore_unk=ignore_unk, minlens=[len(seq) / 2 for seq in seqs],
+            sentence_ids=sentence_ids):
+        if normalize:
+            counts = [len(s) for s in trans]
+            costs = [co / cn for co, cn in zip(costs, counts)]
+        with timed('detokenize'):
+            sentences = [" ".join(indices_to_words(lm_model.word_indxs, t))
+                    for t in trans]
+        results.append((sentences, costs, trans))
+    return results
+
+def sample_many(lm_model, seqs, n_samples, batch_sampler,
+        alpha=1, normalize=False):
+    """Draw n_samples translations of every sequence by one call of
+    the sampler created by create_batch_sampler.
+
+    Returns a list of (sentences, costs) pairs in the order of `seqs`.
+    """
+    x, x_mask = pack_sequences(seqs)
+    values, cond_probs = batch_sampler(n_samples, 3 * (x.shape[0] - 1),
+            alpha, x, x_mask)
+    sentences, costs = cut_samples(lm_model, values, cond_probs, normalize)
+    return [(sentences[i * n_samples:(i + 1) * n_samples],
+                costs[i * n_samples:(i + 1) * n_samples])
+            for i in range(len(seqs))]
+
+def cut_samples(lm_model, values, cond_probs, normalize=False):
+    """Sentences and costs of the samples in the columns of `values`.
+
+    The cost of a sample is its negative log-probability, the sum of
+    `cond_probs` up to its first end of sequence, which is still counted.
+    """
+    if not hasattr(lm_model, 'word_array'):
+        lm_model.word_array = numpy.array([lm_model.word_indxs[i]
+            for i in range(len(lm_model.word_indxs))], dtype=object)
+        lm_model.eol_index = list(lm_model.word_array).index('<eol>')
+    n_steps = values.shape[0]
+    is_eol = values == lm_model.eol_index
+    lengths = numpy.where(is_eol.any(axis=0), is_eol.argmax(axis=0), n_steps)
+    counted = numpy.arange(n_steps)[:, None] <= lengths[None, :]
+    costs = (cond_probs * counted).sum(axis=0)
+    if normalize:
+        costs /= numpy.maximum(lengths, 1)
+    words = lm_model.word_array[values.T]
+    sentences = [" ".join(words[j, :length]) for j, length in enumerate(lengths)]
+    return sentences, costs
+
+# What the file translation workers need. It is filled before the worker
+# processes are forked, so that they share the loaded parameters and the
+# compiled functions with the parent copy-on-write instead of loading
+# and compiling the model again.
+_worker_context = {}
+
+def draw_samples(batch):
+    """Sample translations of a batch of (sentence ids, sequences), return
+    for every sequence its (sentence, cost) pairs sorted by cost."""
+    ctx = _worker_context
+    sentence_ids, seqs = batch
+    results = sample_many(ctx['lm_model'], seqs, ctx['n_samples'],
+            ctx['batch_sampler'], alpha=ctx['alpha'], normalize=ctx['normalize'])
+    return [sorted(zip(sentences, costs), key=lambda pair: pair[1])
+            for sentences, costs in results]
+
+def translate_nbest(batch):
+    """Translate a batch of (sentence ids, sequences), return for every
+    sequence its `nbest` best (translation, cost, word indices, word
+    log-probs, alignment) tuples. The alignment is None if it is not kept.
+    The sentence ids are the line numbers of the input file."""
+    ctx = _worker_context
+    beam_search = ctx['beam_search']
+    sentence_ids, seqs = batch
+    results = sample_batch(ctx['lm_model'], seqs, ctx['n_samples'],
+            beam_search, ignore_unk=ctx['ignore_unk'],
+            normalize=ctx['normalize'], sentence_ids=sentence_ids)
+    nbest = []
+    for i, (sentences, costs, trans) in enumerate(results):
+        log_probs = beam_search.last_log_probs[i]
+        alignments = (beam_search.last_alignments[i]
+                if beam_search.return_alignment else [None] * len(trans))
+        order = numpy.argsort(costs, kind='mergesort')[:ctx['nbest']]
+        nbest.append([(sentences[j], costs[j], trans[j], log_probs[j],
+            alignments[j]) for j in order])
+    return nbest
+
+def length_buckets(seqs, batch_size):
+    """Split sequence indices into batches of sequences of similar length.
+
+    The indices are sorted by sequence length, so that little
+    padding is needed within a batch.
+    """
+    order = numpy.argsort(map(len, seqs), kind='mergesort')
+    return [order[i:i + batch_size] for i in xrange(0, len(order), batch_size)]
+
+def read_windows(lines, window):
+    """Yield lists of at most `window` lines, all the lines if `window` <= 0."""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, window) if window > 0 else lines)
+        if not chunk:
+            break
+        yield chunk
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -208,9 +728,114 @@ def parse_args():
             help="File of source sentences")
     parser.add_argument("--trans",
             help="File to save translations in")
+    parser.add_argument("--batch-size",
+            type=int, default=1,
+            help="Number of sentences translated by one batched beam search"
+                " when translating a file")
+    parser.add_argument("--window",
+            type=int, default=1000,
+            help="Number of lines read at once and sorted by length before"
+                " batching, the whole file if <= 0")
+    parser.add_argument("--workers",
+            type=int, default=1,
+            help="Number of worker processes translating the file."
+                " The workers are forked after the model is compiled and share"
+                " it with the main process. Consider OMP_NUM_THREADS=1.")
+    parser.add_argument("--extra-steps",
+            type=float, default=1.,
+            help="If no translation is finished after 3 steps per source word,"
+                " decode this many more steps per source word before"
+                " forcing the live hypotheses to end")
+    parser.add_argument("--time-budget",
+            type=float, default=None,
+            help="Maximum number of seconds for one beam search")
+    parser.add_argument("--early-stop",
+            action="store_true", default=False,
+            help="Stop extending the hypotheses that cost more than"
+                " the best finished translation")
+    parser.add_argument("--prune-rel",
+            type=float, default=None,
+            help="Prune the hypotheses costing more than (1 + this) times"
+                " the best one at the same step")
+    parser.add_argument("--prune-abs",
+            type=float, default=None,
+            help="Prune the hypotheses costing more than the best one"
+                " at the same step plus this")
+    parser.add_argument("--max-per-parent",
+            type=int, default=None,
+            help="Maximum number of candidates extending one hypothesis")
+    parser.add_argument("--shortlist-top",
+            type=int, default=None,
+            help="Compute the probabilities only for a per-sentence shortlist:"
+                " this many most frequent target words, the unkpos* tokens"
+                " and the candidates from --shortlist-table")
+    parser.add_argument("--shortlist-table",
+            help="Candidate table for the shortlist, lines of"
+                " \"source_word target_word [score]\"")
+    parser.add_argument("--shortlist-per-word",
+            type=int, default=50,
+            help="Number of candidates per source word kept from the table")
+    parser.add_argument("--batch-encoder",
+            action="store_true", default=False,
+            help="Encode all the sentences of a batch by one call of the encoder")
+    parser.add_argument("--encoder-cache-mb",
+            type=float, default=0,
+            help="Keep the encoder outputs of the recent source sentences,"
+                " using at most this many megabytes")
+    parser.add_argument("--encoder-cache-disk",
+            help="File to move the encoder outputs evicted from the memory to."
+                " Every worker of --workers writes its own FILE.<pid>")
+    parser.add_argument("--encoder-cache-disk-mb",
+            type=float, default=1024,
+            help="Size of --encoder-cache-disk in megabytes")
+    parser.add_argument("--profile",
+            help="With beam search and --source: write the time spent in every"
+                " phase of decoding to this file, as CSV if it ends with .csv,"
+                " as JSON otherwise")
+    parser.add_argument("--profile-trace",
+            help="With --profile: write the search statistics of every sentence"
+                " to this file as JSON lines")
+    parser.add_argument("--numpy",
+            action="store_true", default=False,
+            help="Run the beam search with the NumPy implementation"
+                " of the model instead of compiling it with Theano")
+    parser.add_argument("--function-cache",
+            help="Directory to keep the compiled functions in,"
+                " so that they are compiled only once for a state")
     parser.add_argument("--normalize",
             action="store_true", default=False,
             help="Normalize log-prob with the word count")
+    parser.add_argument("--n-samples",
+            type=int, default=1,
+            help="Without beam search: number of samples drawn for every"
+                " source sentence of --source, all of them are written to --trans")
+    parser.add_argument("--alpha",
+            type=float, default=1.,
+            help="Without beam search: inverse temperature of the samples in --source mode")
+    parser.add_argument("--nbest",
+            type=int, default=0,
+            help="With beam search: write the NBEST best translations"
+                " of every sentence of --source to --nbest-out")
+    parser.add_argument("--nbest-out",
+            help="File of the n-best lists, the prefix of the files for --nbest-format binary")
+    parser.add_argument("--nbest-format",
+            default="text", choices=["text", "binary"],
+            help="text: 'sentence ||| translation ||| cost' lines,"
+                " binary: memory mappable arrays, see nbest.py")
+    parser.add_argument("--word-log-probs",
+            action="store_true", default=False,
+            help="Add the log-probability of every word to the n-best lists")
+    parser.add_argument("--nbest-alignment",
+            action="store_true", default=False,
+            help="Add the source position of the highest attention of every word"
+                " to the n-best lists (RNNsearch only)")
+    parser.add_argument("--replace-unkpos",
+            action="store_true", default=False,
+            help="With beam search: replace the unkpos* tokens of the translations"
+                " of --source by the source words they point to")
+    parser.add_argument("--unkpos-dict",
+            help="Dictionary of 'source_word target_word' lines (e.g. of proper nouns)"
+                " to translate the source words put in place of unkpos* tokens")
     parser.add_argument("--verbose",
             action="store_true", default=False,
             help="Be verbose")
@@ -231,53 +856,165 @@ def main():
 
     logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
 
-    rng = numpy.random.RandomState(state['seed'])
-    enc_dec = RNNEncoderDecoder(state, rng, skip_init=True)
-    enc_dec.build()
+    if args.numpy:
+        # Beam search without Theano
+        assert args.beam_search and not args.batch_encoder
+        enc_dec = NumpyEncoderDecoder(state)
+    else:
+        rng = numpy.random.RandomState(state['seed'])
+        enc_dec = RNNEncoderDecoder(state, rng, skip_init=True)
+        enc_dec.build()
     lm_model = enc_dec.create_lm_model()
     lm_model.load(args.model_path)
+    if args.function_cache and not args.numpy:
+        enc_dec.load_functions(args.function_cache)
     indx_word = cPickle.load(open(state['word_indx'],'rb'))
 
+    shortlist = None
+    if args.shortlist_top is not None:
+        candidates = None
+        if args.shortlist_table:
+            candidates = load_candidates(args.shortlist_table, indx_word,
+                    cPickle.load(open(state['word_indx_trgt'], 'rb')),
+                    args.shortlist_per_word)
+        always = [state['null_sym_target'], state['unk_sym_target']] + [i
+                for i, word in lm_model.word_indxs.items()
+                if word.startswith('unkpos')]
+        shortlist = Shortlist(args.shortlist_top, state['n_sym_target'],
+                candidates, always)
+
     sampler = None
+    batch_sampler = None
     beam_search = None
+    profiler = None
+    if args.profile:
+        assert args.workers == 1
+        profiler = Profiler(args.profile_trace)
+    encoder_cache = None
+    if args.encoder_cache_mb:
+        encoder_cache = EncoderCache(int(args.encoder_cache_mb * 2 ** 20),
+                args.encoder_cache_disk, int(args.encoder_cache_disk_mb * 2 ** 20))
     if args.beam_search:
-        beam_search = BeamSearch(enc_dec)
+        beam_search = BeamSearch(enc_dec,
+                extra_steps_factor=args.extra_steps,
+                time_budget=args.time_budget,
+                early_stop=args.early_stop,
+                rel_threshold=args.prune_rel,
+                abs_threshold=args.prune_abs,
+                max_per_parent=args.max_per_parent,
+                shortlist=shortlist,
+                return_alignment=args.replace_unkpos or args.nbest_alignment,
+                batch_encoder=args.batch_encoder,
+                encoder_cache=encoder_cache,
+                profiler=profiler)
         beam_search.compile()
+    elif args.source and args.trans:
+        batch_sampler = enc_dec.create_batch_sampler()
     else:
         sampler = enc_dec.create_sampler(many_samples=True)
+    if args.function_cache and not args.numpy:
+        enc_dec.save_functions(args.function_cache)
 
     idict_src = cPickle.load(open(state['indx_word'],'r'))
 
     if args.source and args.trans:
-        # Actually only beam search is currently supported here
-        assert beam_search
-        assert args.beam_size
-
         fsrc = open(args.source, 'r')
         ftrans = open(args.trans, 'w')
 
         start_time = time.time()
 
-        n_samples = args.beam_size
+        nbest_writer = None
+        replacer = None
+        if args.replace_unkpos:
+            assert beam_search
+            replacer = Replacer(lm_model.word_indxs,
+                    load_dictionary(args.unkpos_dict) if args.unkpos_dict else None,
+                    eos_id=state['null_sym_target'])
+        if beam_search:
+            n_samples = args.beam_size
+            translate = translate_nbest
+            logging.debug("Beam size: {}".format(n_samples))
+            if args.nbest:
+                assert args.nbest <= n_samples and args.nbest_out
+                nbest_writer = NBestWriter(args.nbest_out,
+                        binary=args.nbest_format == "binary",
+                        log_probs=args.word_log_probs,
+                        alignments=args.nbest_alignment)
+        else:
+            # Every sample is written, sorted by cost
+            n_samples = args.n_samples
+            translate = draw_samples
+            logging.debug("Samples per sentence: {}".format(n_samples))
         total_cost = 0.0
-        logging.debug("Beam size: {}".format(n_samples))
-        for i, line in enumerate(fsrc):
-            seqin = line.strip()
-            seq, parsed_in = parse_input(state, indx_word, seqin, idx2word=idict_src)
-            if args.verbose:
-                print "Parsed Input:", parsed_in
-            trans, costs, _ = sample(lm_model, seq, n_samples, sampler=sampler,
-                    beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-            best = numpy.argmin(costs)
-            print >>ftrans, trans[best]
-            if args.verbose:
-                print "Translation:", trans[best]
-            total_cost += costs[best]
-            if (i + 1)  % 100 == 0:
-                ftrans.flush()
-                logger.debug("Current speed is {} per sentence".
-                        format((time.time() - start_time) / (i + 1)))
+        n_done = 0
+        logging.debug("Batch size: {}".format(args.batch_size))
+
+        _worker_context.update(lm_model=lm_model, beam_search=beam_search,
+                batch_sampler=batch_sampler, n_samples=n_samples,
+                ignore_unk=args.ignore_unk, normalize=args.normalize,
+                alpha=args.alpha, nbest=max(args.nbest, 1))
+        pool = None
+        translate_map = itertools.imap
+        if args.workers > 1:
+            logger.debug("Forking {} workers".format(args.workers))
+            pool = multiprocessing.Pool(args.workers)
+            translate_map = pool.imap
+
+        for lines in read_windows(fsrc, args.window):
+            seqs = []
+            for line in lines:
+                seqin = line.strip()
+                with (profiler.phase('parse_input') if profiler else _untimed()):
+                    seq, parsed_in = parse_input(state, indx_word, seqin, idx2word=idict_src)
+                if args.verbose:
+                    print "Parsed Input:", parsed_in
+                seqs.append(seq)
+
+            # Translate the sentences in batches of similar length
+            # and put the results back in the original order. Every result
+            # is a list of hypotheses, (translation, cost, ...) tuples.
+            all_hyps = [None] * len(seqs)
+            buckets = length_buckets(seqs, args.batch_size)
+            for bucket, results in zip(buckets, translate_map(translate,
+                    [([n_done + i for i in bucket], [seqs[i] for i in bucket])
+                        for bucket in buckets])):
+                for i, hyps in zip(bucket, results):
+                    all_hyps[i] = hyps
+
+            if replacer:
+                # All the hypotheses of the window at once
+                sources = [line.split() for line, hyps in zip(lines, all_hyps)
+                        for hyp in hyps]
+                replaced = iter(replacer([hyp[2] for hyps in all_hyps for hyp in hyps],
+                    sources, [hyp[4] for hyps in all_hyps for hyp in hyps]))
+                all_hyps = [[(next(replaced),) + hyp[1:] for hyp in hyps]
+                        for hyps in all_hyps]
+
+            for i, hyps in enumerate(all_hyps):
+                if nbest_writer:
+                    nbest_writer.write(n_done + i, *([list(h) for h in zip(*hyps)]
+                        if hyps else [[]] * 5))
+                # Only the best translation of beam search, all the samples
+                if beam_search and not hyps:
+                    hyps = [("", 0.)]
+                for hyp in (hyps[:1] if beam_search else hyps):
+                    print >>ftrans, hyp[0]
+                    total_cost += hyp[1]
+                    if args.verbose:
+                        print "Translation:", hyp[0]
+            ftrans.flush()
+            n_done += len(seqs)
+            logger.debug("Current speed is {} per sentence".
+                    format((time.time() - start_time) / n_done))
+        if pool:
+            pool.close()
+            pool.join()
         print "Total cost of the translations: {}".format(total_cost)
+        if nbest_writer:
+            nbest_writer.close()
+        if profiler:
+            profiler.save(args.profile)
+            logger.info("Profile: {}".format(dict(profiler.summary())))
 
         fsrc.close()
         ftrans.close()
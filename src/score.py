@@ -100,6 +100,8 @@ def parse_args():
             help="Print more stuff")
     parser.add_argument("--y-noise",  type=float,
             help="Probability for a word to be replaced by a random word")
+    parser.add_argument("--function-cache",
+            help="Directory to keep the compiled functions in")
 
     # Additional arguments
     parser.add_argument("changes",  nargs="?", help="Changes to state", default="")
@@ -126,6 +128,8 @@ def main():
     enc_dec.build()
     lm_model = enc_dec.create_lm_model()
     lm_model.load(args.model_path)
+    if args.function_cache:
+        enc_dec.load_functions(args.function_cache)
 
     indx_word_src = cPickle.load(open(state['word_indx'],'rb'))
     indx_word_trgt = cPickle.load(open(state['word_indx_trgt'], 'rb'))
@@ -150,6 +154,8 @@ def main():
         score_file = open(args.scores, "w") if args.scores else sys.stdout
 
         scorer = enc_dec.create_scorer(batch=True)
+        if args.function_cache:
+            enc_dec.save_functions(args.function_cache)
 
         count = 0
         n_samples = 0
@@ -189,9 +195,11 @@ def main():
         score_file.flush()
     elif args.mode == "interact":
         scorer = enc_dec.create_scorer()
+        compute_probs = enc_dec.create_probs_computer()
+        if args.function_cache:
+            enc_dec.save_functions(args.function_cache)
         while True:
             try:
-                compute_probs = enc_dec.create_probs_computer()
                 src_line = raw_input('Source sequence: ')
                 trgt_line = raw_input('Target sequence: ')
                 src_seq = parse_input(state, indx_word_src, src_line, raise_unk=not args.allow_unk, 
@@ -210,6 +218,8 @@ def main():
         src_file = open(args.src, "r")
         trg_file = open(args.trg, "r")
         compute_probs = enc_dec.create_probs_computer(return_alignment=True)
+        if args.function_cache:
+            enc_dec.save_functions(args.function_cache)
         try:
             numpy.set_printoptions(precision=3, linewidth=150, suppress=True)
             i = 0
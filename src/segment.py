@@ -10,9 +10,10 @@ import traceback
 import logging
 import numpy
 import time
-from itertools import izip, product
+from itertools import izip, product, groupby
 from sample import BeamSearch
-from sample import sample as sample_func
+from sample import sample_batch
+from sample import length_buckets
 from collections import defaultdict
 import operator
 
@@ -20,21 +21,85 @@ from encdec import RNNEncoderDecoder
 from encdec import get_batch_iterator
 from encdec import parse_input
 from encdec import create_padded_batch
+from phrase_cache import PhraseCache, model_identity
 
 from state import prototype_state
 
-cache = dict()
+logger = logging.getLogger(__name__)
 
-def cached_sample_func(model, phrase, n_samples, sampler, beam_search):
-    global cache
-    k = (tuple(phrase), n_samples)
-    if not k in cache:
-        cache[k] = sample_func(model, phrase, n_samples, sampler, beam_search)
-    return cache[k]
+# Phrases in the cache of a SegmentationEngine if no other is given
+DEFAULT_CACHE_ENTRIES = 100000
 
-logger = logging.getLogger(__name__)
+class SegmentationEngine(object):
+    """The models of both directions and everything compiled for them.
+
+    The beam search and the reverse scorer are compiled once, when the
+    engine is created, and are used for all the phrases of all the
+    sentences of a job.
+    """
+
+    def __init__(self, lm_model, enc_dec, indx_word_src, indx_word_trgt, state,
+            lm_model_fr_2_en=None, enc_dec_fr_2_en=None, state_fr2en=None,
+            cache=None, reverse_batch_size=128):
+        """
+        :param cache:
+            a PhraseCache for the translations of lm_model, by default
+            one kept in memory
+
+        :param reverse_batch_size:
+            the number of phrase pairs scored together by the reverse model
+        """
+        self.__dict__.update(locals())
+        self.__dict__.pop('self')
+        self.beam_search = BeamSearch(enc_dec)
+        self.beam_search.compile()
+        self.reverse_scorer = None
+        if enc_dec_fr_2_en is not None:
+            self.reverse_scorer = enc_dec_fr_2_en.create_scorer(batch=True)
+        if self.cache is None:
+            self.cache = PhraseCache(model_identity(lm_model, state),
+                    DEFAULT_CACHE_ENTRIES)
+
+    def translate_batch(self, phrases, n_samples):
+        """(sentences, costs, trans) of the beam search for every phrase,
+        the best translations only, see PhraseCache.
+
+        The phrases that are not cached yet are translated by one
+        batched beam search.
+        """
+        # The same phrase may occur several times, it is looked up once
+        results = dict((tuple(phrase), None) for phrase in phrases)
+        missing = []
+        for key in results:
+            results[key] = self.cache.get(key, n_samples)
+            if results[key] is None:
+                missing.append(key)
+        if missing:
+            translated = sample_batch(self.lm_model,
+                    [numpy.array(key, dtype="int64") for key in missing],
+                    n_samples, self.beam_search)
+            for key, result in zip(missing, translated):
+                results[key] = self.cache.put(key, n_samples, result)
+        return [results[tuple(phrase)] for phrase in phrases]
+
+    def reverse_costs(self, sources, targets):
+        """The costs of the sources given the targets under the reverse
+        model, computed in batches of targets of similar length."""
+        costs = numpy.zeros(len(sources))
+        for bucket in length_buckets(targets, self.reverse_batch_size):
+            x = numpy.empty(len(bucket), dtype=object)
+            y = numpy.empty(len(bucket), dtype=object)
+            x[:] = [targets[k] for k in bucket]
+            y[:] = [sources[k] for k in bucket]
+            # No sequence is cut, the batch is padded to the longest one
+            state = dict(self.state_fr2en, trim_batches=True,
+                    seqlen=max(max(map(len, x)), max(map(len, y))))
+            x, x_mask, y, y_mask = create_padded_batch(state, [x], [y])
+            costs[bucket] = -self.reverse_scorer(x, y, x_mask, y_mask)[0]
+        return costs
 
 def get_models():
+    """Load the models and create the SegmentationEngine for them."""
     args = parse_args()
 
     state_en2fr = prototype_state()
@@ -54,21 +119,34 @@ def get_models():
     enc_dec_en_2_fr.build()
     lm_model_en_2_fr = enc_dec_en_2_fr.create_lm_model()
     lm_model_en_2_fr.load(args.model_path_en2fr)
+    if args.function_cache:
+        enc_dec_en_2_fr.load_functions(args.function_cache)
     indx_word_src = cPickle.load(open(state_en2fr['word_indx'],'rb'))
     indx_word_trgt = cPickle.load(open(state_en2fr['word_indx_trgt'], 'rb'))
 
+    lm_model_fr_2_en = enc_dec_fr_2_en = None
     if hasattr(args, 'state_fr2en') and args.state_fr2en is not None:
         rng = numpy.random.RandomState(state_fr2en['seed'])
         enc_dec_fr_2_en = RNNEncoderDecoder(state_fr2en, rng, skip_init=True)
         enc_dec_fr_2_en.build()
         lm_model_fr_2_en = enc_dec_fr_2_en.create_lm_model()
         lm_model_fr_2_en.load(args.model_path_fr2en)
-
-        return [lm_model_en_2_fr, enc_dec_en_2_fr, indx_word_src, indx_word_trgt, state_en2fr, \
-            lm_model_fr_2_en, enc_dec_fr_2_en, state_fr2en]
+        if args.function_cache:
+            enc_dec_fr_2_en.load_functions(args.function_cache)
     else:
-        return [lm_model_en_2_fr, enc_dec_en_2_fr, indx_word_src, indx_word_trgt, state_en2fr,\
-                None, None, None]
+        state_fr2en = None
+
+    cache = PhraseCache(model_identity(lm_model_en_2_fr, state_en2fr),
+            args.phrase_cache_size, path=args.phrase_cache)
+    engine = SegmentationEngine(lm_model_en_2_fr, enc_dec_en_2_fr,
+            indx_word_src, indx_word_trgt, state_en2fr,
+            lm_model_fr_2_en, enc_dec_fr_2_en, state_fr2en,
+            cache=cache, reverse_batch_size=args.reverse_batch_size)
+    if args.function_cache:
+        enc_dec_en_2_fr.save_functions(args.function_cache)
+        if enc_dec_fr_2_en is not None:
+            enc_dec_fr_2_en.save_functions(args.function_cache)
+    return engine
 
 def chunks(l, n):
     """
@@ -96,24 +174,67 @@ def parse_args():
                         action='store_true')
     parser.add_argument("--reverse_score", help="use a fr2en model to add to the score",
                         action='store_true')
+    parser.add_argument("--reverse-batch-size", type=int, default=128,
+        help="Number of phrase pairs scored together by the fr2en model")
     parser.add_argument("--add_period", help="Add a period at the end of each phrase",
                         action='store_true')
     parser.add_argument("--changes",  nargs="?", help="Changes to state", default="")
+    parser.add_argument("--function-cache", help="Directory to keep the compiled functions in")
+    parser.add_argument("--phrase-cache", help="File to load the phrase translations from and save them to")
+    parser.add_argument("--phrase-cache-size", type=int, default=DEFAULT_CACHE_ENTRIES,
+        help="Number of phrases to keep the translations of")
+    parser.add_argument("--phrase-cache-save-every", type=int, default=100,
+        help="Save the phrase translations every that many sentences")
     parser.add_argument("--old_begin", type=int, default=0, help="first line to start translating")
     parser.add_argument("--end", type=int, default=10, help="last line to translate (included)")
     return parser.parse_args()
 
 
-def process_sentence(source_sentence, model, max_phrase_length, n_samples,
-                     copy_UNK_words, add_period, normalize, reverse_score):
+class PhraseCandidates(object):
+    """The best translations of a phrase with their costs.
 
-    #Setting up comp_score function
-    logger.debug("setting up comp_score function")
-    [lm_model, enc_dec, indx_word_src, indx_word_trgt, state, \
-            lm_model_fr_2_en, enc_dec_fr_2_en, state_fr2en] = model
+    The translation and the score used for the segmentation depend on
+    the options (normalize, reverse_score), they are chosen by `best`.
+    """
+
+    def __init__(self, trans, trans_bin, costs, length, reverse_costs=None,
+            fixed=False):
+        """
+        :param length: length of the phrase, end of sequence included
+        :param fixed:
+            the translation is not chosen by the model (copied UNK words),
+            its cost does not depend on the options
+        """
+        self.__dict__.update(locals())
+        self.__dict__.pop('self')
+
+    def best(self, normalize, reverse_score):
+        if self.fixed:
+            return self.trans[0], self.costs[0]
+        scores = list(self.costs)
+        if reverse_score:
+            for index in xrange(len(scores)):
+                scores[index] = (scores[index] + self.reverse_costs[index]) / 2.
+        trans = self.trans[numpy.argmin(scores)]
+        score = numpy.min(scores)
+        if normalize:
+            score = score / numpy.log(self.length + 1)
+        return trans, score
+
+
+def process_sentence(source_sentence, engine, max_phrase_length, n_samples,
+                     copy_UNK_words, add_period, reverse_score):
+    """Translate all the phrases of a sentence and the whole sentence.
+
+    Returns PhraseCandidates for every (i, j) span and for the
+    whole sentence. The reverse costs are computed if `reverse_score`.
+    """
+
+    state = engine.state
+    indx_word_src = engine.indx_word_src
 
     eol_src = state['null_sym_source']
-    src_seq = parse_input(state, indx_word_src, source_sentence)
+    src_seq, _ = parse_input(state, indx_word_src, source_sentence)
     if src_seq[-1] == eol_src:
         src_seq = src_seq[:-1]
     n_s = len(src_seq)
@@ -137,92 +258,95 @@ def process_sentence(source_sentence, model, max_phrase_length, n_samples,
         for i, j in index_order_list:
             tiled_source_phrase_list.append(numpy.hstack((src_seq[i:j+1], eol_src)))
 
-
-    #Compute nested score dictionary
-    logger.debug("computing nested score dictionary")
-    score_dict = {}
-    trans = {}
+    #Translate the phrases of every length by one batched beam search
+    translations = {}
+    for length, group in groupby(range(len(index_order_list)),
+            key=lambda idx: index_order_list[idx][1] - index_order_list[idx][0]):
+        group = list(group)
+        if copy_UNK_words:
+            group = [idx for idx in group
+                    if not any(word == 1 for word in tiled_source_phrase_list[idx])]
+        logger.debug("Translating {} phrases of length {}".format(len(group), length + 1))
+        if group:
+            results = engine.translate_batch(
+                    [tiled_source_phrase_list[idx] for idx in group], n_samples)
+            for idx, result in zip(group, results):
+                translations[tuple(index_order_list[idx])] = result
+
+    #Compute nested candidates dictionary
+    logger.debug("computing nested candidates dictionary")
+    candidates = {}
+    to_reverse_score = []
 
     for phrase_idx in xrange(0, len(index_order_list)):
         logger.debug("{0} out of {1}".format(phrase_idx, len(index_order_list)))
         i, j = index_order_list[phrase_idx]
         logger.debug("Translating phrase : {}".format(" ".join(source_sentence.strip().split()[i:j+1])))
 
+        phrase_to_translate = tiled_source_phrase_list[phrase_idx]
+        n_UNK_words = 0
         if copy_UNK_words == True:
-            phrase_to_translate = tiled_source_phrase_list[phrase_idx]
             n_UNK_words = numpy.sum([word == 1 for word in phrase_to_translate])
-            if n_UNK_words >= 1 and n_UNK_words == len(phrase_to_translate) - 1:
-                suggested_translation = " ".join(source_sentence.strip().split()[i:j+1])
-                trans[i, j] = suggested_translation
-                score = .0001
-                score_dict[i, j] = score
-            if n_UNK_words >= 1 and n_UNK_words != len(phrase_to_translate) -1:
-                suggested_translation = "WILL NOT BE USED"
-                trans[i, j] = suggested_translation
-                score = 1e9
-                score_dict[i, j] = score
-            if n_UNK_words == 0:
-                suggested_translation, score = sample_targets(
-                                                    input_phrase= \
-                                                           tiled_source_phrase_list[phrase_idx],
-                                                    model=model,
-                                                    n_samples=n_samples,
-                                                    reverse_score=reverse_score,
-                                                    normalize=normalize
-                )
-                trans[i, j] = suggested_translation
-                score_dict[i, j] = score
-
+        if n_UNK_words >= 1 and n_UNK_words == len(phrase_to_translate) - 1:
+            suggested_translation = " ".join(source_sentence.strip().split()[i:j+1])
+            candidates[i, j] = PhraseCandidates([suggested_translation], None,
+                    [.0001], len(phrase_to_translate), fixed=True)
+        elif n_UNK_words >= 1:
+            candidates[i, j] = PhraseCandidates(["WILL NOT BE USED"], None,
+                    [1e9], len(phrase_to_translate), fixed=True)
         else:
-            phrase_to_translate = tiled_source_phrase_list[phrase_idx]
-            suggested_translation, score = sample_targets(
-                                                input_phrase=phrase_to_translate,
-                                                model=model, n_samples=n_samples,
-                                                reverse_score=reverse_score,
-                                                normalize=normalize
-            )
-            trans[i, j] = suggested_translation
-            score_dict[i, j] = score
+            candidates[i, j] = sample_targets(input_phrase=phrase_to_translate,
+                                              translation=translations[i, j])
+            to_reverse_score.append(((i, j), phrase_to_translate))
+
+    #Translation of full sentence without segmentation
+    logger.debug("Translating full sentence")
+    phrase_to_translate = numpy.hstack((src_seq, eol_src))
+    full_span = (0, n_s - 1)
+    if not add_period and full_span in translations:
+        # The whole sentence was translated as its longest phrase
+        full_translation = translations[full_span]
+    else:
+        full_translation = engine.translate_batch([phrase_to_translate], n_samples)[0]
+    full_candidates = sample_targets(input_phrase=phrase_to_translate,
+                                     translation=full_translation)
+
+    if reverse_score:
+        add_reverse_costs([candidates[span] for span, _ in to_reverse_score]
+                            + [full_candidates],
+                          [source for _, source in to_reverse_score]
+                            + [phrase_to_translate],
+                          engine)
+
+    return candidates, full_candidates
+
+
+def select_translations(candidates, n_s, normalize, reverse_score, add_period):
+    """The translation and the score of every span for the options."""
+    trans = {}
+    score_dict = {}
+    for (i, j), phrase_candidates in candidates.items():
+        trans[i, j], score_dict[i, j] = phrase_candidates.best(normalize, reverse_score)
 
     #Remove the period at the end if not last word
     #Lower case first word if not first word
     if add_period:
-       for phrase_idx in xrange(0, len(index_order_list)):
-           i, j = index_order_list[phrase_idx]
+       for i, j in candidates:
            if i != 0:
                trans[i, j] = " ".join([trans[i,j][0].lower()] + [trans[i,j][1:]])
-           if j != len(src_seq) - 1:
+           if j != n_s - 1:
                last_word = trans[i,j].strip().split()[-1]
                if last_word == '.':
                    trans[i,j] = " ".join(trans[i,j].strip().split()[:-1])
 
+    return trans, score_dict
 
-    #Translation of full sentence without segmentation
-    logger.debug("Translating full sentence")
-    phrase_to_translate = numpy.hstack((src_seq, eol_src))
-    full_translation, __ = sample_targets(input_phrase=phrase_to_translate,
-                                          model=model,
-                                          n_samples=n_samples,
-                                          reverse_score=reverse_score,
-                                          normalize=normalize
-    )
-    logger.debug("Translation output:".format(full_translation))
-
-    return trans, score_dict, full_translation
-
-
-def sample_targets(input_phrase, model, n_samples, reverse_score, normalize):
-
-    [lm_model, enc_dec, indx_word_src, indx_word_trgt, state, \
-            lm_model_fr_2_en, enc_dec_fr_2_en, state_fr2en] = model
 
-    beam_search = BeamSearch(enc_dec)
-    beam_search.compile()
-    sampler = enc_dec.create_sampler(many_samples=True)
+def sample_targets(input_phrase, translation):
+    """PhraseCandidates of the phrase: the 10 best of its translations,
+    (sentences, costs, trans) as given by translate_batch."""
 
-    #sample_func can take argument : normalize (bool)
-    trans, scores, trans_bin = cached_sample_func(lm_model, input_phrase, n_samples,
-                                           sampler=sampler, beam_search=beam_search)
+    trans, scores, trans_bin = translation
 
     #Reordering scores-trans
     #Warning : selection of phrases to rescore is hard-coded
@@ -230,63 +354,54 @@ def sample_targets(input_phrase, model, n_samples, reverse_score, normalize):
     trans_bin = [tra_bin for (sco, tra_bin) in sorted(zip(scores, trans_bin))][0:10]
     scores = sorted(scores)[0:10]
 
-    #Reverse scoring of selected phrases
-    if reverse_score:
-        reverse_scorer = enc_dec_fr_2_en.create_scorer(batch=True)
-
-        source_phrases_to_reverse_score = []
-        target_phrases_to_reverse_score = []
-        for tra_bin in trans_bin:
-            source_phrases_to_reverse_score.append(input_phrase)
-            target_phrases_to_reverse_score.append(tra_bin)
-
-        state_fr2en['seqlen'] = 1000
-        x, x_mask, y, y_mask = create_padded_batch(
-                                    state_fr2en,
-                                    [numpy.asarray(target_phrases_to_reverse_score)],
-                                    [numpy.asarray(source_phrases_to_reverse_score)])
+    return PhraseCandidates(trans, trans_bin, scores, len(input_phrase))
 
-        reverse_scores = - reverse_scorer(numpy.atleast_2d(x), numpy.atleast_2d(y),
-                                          numpy.atleast_2d(x_mask),
-                                          numpy.atleast_2d(y_mask))[0]
 
-        for index in xrange(len(scores)):
-            scores[index] = (scores[index] + reverse_scores[index]) / 2.
+def add_reverse_costs(all_candidates, sources, engine):
+    """Score the translations of all the phrases with the reverse model
+    at once, the costs are stored in the candidates."""
+    candidate_sources = []
+    candidate_targets = []
+    for phrase_candidates, source in zip(all_candidates, sources):
+        candidate_sources.extend([source] * len(phrase_candidates.trans_bin))
+        candidate_targets.extend(phrase_candidates.trans_bin)
 
-    else:
-        for index in xrange(len(scores)):
-            scores[index] = scores[index]
-
-    trans = trans[numpy.argmin(scores)]
-    score = numpy.min(scores)
+    logger.debug("Reverse scoring {} translations".format(len(candidate_targets)))
+    costs = engine.reverse_costs(candidate_sources, candidate_targets)
+    start = 0
+    for phrase_candidates in all_candidates:
+        end = start + len(phrase_candidates.trans_bin)
+        phrase_candidates.reverse_costs = costs[start:end]
+        start = end
 
-    if normalize == False:
-        final_score = score
-    else:
-        final_score = score / numpy.log(len(input_phrase) + 1)
 
-    return trans, final_score
-
-
-def find_align(source, model, max_phrase_length, n_samples,
+def find_align(source, engine, max_phrase_length, n_samples,
         f_trans, f_total,
         normalize=False, copy_UNK_words=False,
-        add_period=False, reverse_score=False):
+        add_period=False, reverse_score=False,
+        candidates=None):
+    """Segment and translate the sentence, write the results.
 
-    [lm_model, enc_dec, indx_word_src, indx_word_trgt, state, \
-            lm_model_fr_2_en, enc_dec_fr_2_en, state_fr2en] = model
+    :param candidates:
+        the result of process_sentence for the sentence, computed here
+        if not given
+    """
 
     split_source_sentence = source.strip().split()
     n_s = len(split_source_sentence)
 
     #Sampling and computing scores : bottleneck
-    phrases, scores, full_translation = process_sentence(source_sentence=source, model=model,
-                                            max_phrase_length=max_phrase_length,
-                                            n_samples=n_samples,
-                                            normalize=normalize,
-                                            copy_UNK_words=copy_UNK_words,
-                                            add_period=add_period,
-                                            reverse_score=reverse_score)
+    if candidates is None:
+        candidates = process_sentence(source_sentence=source, engine=engine,
+                                      max_phrase_length=max_phrase_length,
+                                      n_samples=n_samples,
+                                      copy_UNK_words=copy_UNK_words,
+                                      add_period=add_period,
+                                      reverse_score=reverse_score)
+    phrase_candidates, full_candidates = candidates
+    phrases, scores = select_translations(phrase_candidates, n_s,
+            normalize, reverse_score, add_period)
+    full_translation = full_candidates.best(normalize, reverse_score)[0]
 
     #Starting segmentation
     logger.debug("starting segmentation")
@@ -337,10 +452,14 @@ def find_align(source, model, max_phrase_length, n_samples,
     f_total.flush()
     f_trans.flush()
 
-def main_with_segmentation(begin, end, n_samples,
+def main_with_segmentation(engine, begin, end, n_samples,
         source, console,
-        options, outputs):
-    model = get_models()
+        options, outputs, save_every=100):
+    """Segment and translate the lines begin..end of source with each
+    of the options, writing to the matching outputs.
+
+    The functions of the engine are compiled once for all the lines.
+    """
     max_phrase_length = 20
 
     s_text = []
@@ -362,12 +481,26 @@ def main_with_segmentation(begin, end, n_samples,
 
     logger.debug("Translating with beam size {}".format(n_samples))
     for source in s_text:
-        global cache
-        cache = dict()
+        # The phrases are translated and scored once for all the options
+        # sharing copy_UNK_words and add_period
+        tables = {}
+        for opts in options:
+            key = (opts.get('copy_UNK_words', False), opts.get('add_period', False))
+            tables[key] = tables.get(key, False) or opts.get('reverse_score', False)
+        for key, reverse_score in tables.items():
+            copy_UNK_words, add_period = key
+            tables[key] = process_sentence(source_sentence=source, engine=engine,
+                                           max_phrase_length=max_phrase_length,
+                                           n_samples=n_samples,
+                                           copy_UNK_words=copy_UNK_words,
+                                           add_period=add_period,
+                                           reverse_score=reverse_score)
 
         for opts, (f_trans, f_total) in zip(options, outputs):
-            find_align(source, model, max_phrase_length, n_samples,
+            key = (opts.get('copy_UNK_words', False), opts.get('add_period', False))
+            find_align(source, engine, max_phrase_length, n_samples,
                     f_trans, f_total,
+                    candidates=tables[key],
                     **opts)
 
         counter_total += 1
@@ -378,8 +511,12 @@ def main_with_segmentation(begin, end, n_samples,
         logger.debug("total time : {}".format(t1 - t0))
         logger.debug("sentence processed : {}".format(counter_total + begin))
         logger.debug("total sentences processed : {}".format(counter_processed))
+        logger.debug("Phrase cache: {}".format(engine.cache.stats()))
+        if counter_processed % save_every == 0:
+            engine.cache.save()
         print(counter_total + begin - 1, file=console)
         console.flush()
+    engine.cache.save()
 
 
 def main():
@@ -433,9 +570,10 @@ def main():
             open(total_file_name.format(k), 'a'))
         for k in modes]
 
-    main_with_segmentation(begin, end, n_samples,
+    engine = get_models()
+    main_with_segmentation(engine, begin, end, n_samples,
             source, console,
-            options, outputs)
+            options, outputs, args.phrase_cache_save_every)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Translation server.
+
+Keeps a model compiled in memory and translates the sentences sent to it
+over a loopback TCP or a Unix socket. The protocol is JSON lines: a
+request {"source": "...", "id": ...} is answered by
+{"id": ..., "translation": "...", "cost": ...}, and {"command": "stats"}
+by the current statistics. The requests of all the connections are
+queued, grouped into batches of sentences of similar length and
+translated by the batched beam search.
+"""
+
+import argparse
+import cPickle
+import collections
+import json
+import logging
+import os
+import Queue
+import SocketServer
+import threading
+import time
+
+import numpy
+
+from encdec import RNNEncoderDecoder, parse_input
+from sample import BeamSearch, sample_batch, length_buckets
+from state import prototype_state
+
+logger = logging.getLogger(__name__)
+
+class Request(object):
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.translation = None
+        self.cost = None
+
+class Stats(object):
+    """Queue depth, batch sizes and latencies of the server."""
+
+    def __init__(self, queue, window=1000):
+        self.queue = queue
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.n_translated = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, requests):
+        now = time.time()
+        with self.lock:
+            self.batch_sizes.append(len(requests))
+            self.latencies.extend(now - r.arrival for r in requests)
+            self.n_translated += len(requests)
+
+    def summary(self):
+        with self.lock:
+            latencies = numpy.array(self.latencies)
+            batch_sizes = numpy.array(self.batch_sizes)
+            summary = dict(queue_depth=self.queue.qsize(),
+                    translated=self.n_translated,
+                    last_batch_size=int(batch_sizes[-1]) if len(batch_sizes) else 0,
+                    mean_batch_size=float(batch_sizes.mean()) if len(batch_sizes) else 0.)
+            for p in [50, 90, 99]:
+                summary['latency_p{}'.format(p)] = (
+                    float(numpy.percentile(latencies, p)) if len(latencies) else 0.)
+        return summary
+
+class Batcher(object):
+    """Collects the queued requests into micro-batches and translates them.
+
+    A batch is started by the oldest waiting request. More requests are
+    taken for at most `max_wait` seconds or until `max_batch` requests
+    are collected, and the collected ones are translated in batches of
+    sentences of similar length.
+    """
+
+    def __init__(self, lm_model, beam_search, beam_size,
+            max_batch, max_wait, ignore_unk=False, normalize=False):
+        self.__dict__.update(locals())
+        self.__dict__.pop('self')
+        self.queue = Queue.Queue()
+        self.stats = Stats(self.queue)
+
+    def submit(self, seq):
+        request = Request(seq)
+        self.queue.put(request)
+        request.done.wait()
+        return request
+
+    def _collect(self):
+        requests = [self.queue.get()]
+        deadline = requests[0].arrival + self.max_wait
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return requests
+
+    def run(self):
+        while True:
+            requests = self._collect()
+            seqs = [r.seq for r in requests]
+            for bucket in length_buckets(seqs, self.max_batch):
+                batch = [requests[i] for i in bucket]
+                try:
+                    results = sample_batch(self.lm_model, [r.seq for r in batch],
+                            self.beam_size, self.beam_search,
+                            ignore_unk=self.ignore_unk, normalize=self.normalize)
+                except Exception:
+                    logger.exception("Translation failed")
+                    results = [([], [], None)] * len(batch)
+                self.stats.add_batch(batch)
+                for request, (sentences, costs, _) in zip(batch, results):
+                    if len(sentences):
+                        best = numpy.argmin(costs)
+                        request.translation = sentences[best]
+                        request.cost = float(costs[best])
+                    request.done.set()
+            logger.debug("Translated a batch of {}, {} requests waiting".format(
+                len(requests), self.queue.qsize()))
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+                if message.get('command') == 'stats':
+                    response = server.batcher.stats.summary()
+                else:
+                    seq, _ = parse_input(server.state, server.indx_word,
+                            message['source'].encode('utf-8').strip(),
+                            idx2word=server.idict_src)
+                    request = server.batcher.submit(seq)
+                    response = dict(id=message.get('id'),
+                            translation=request.translation, cost=request.cost)
+            except Exception as e:
+                logger.exception("Bad request")
+                response = dict(error=str(e))
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Serve translations of a model over a local socket")
+    parser.add_argument("--state",
+            required=True, help="State to use")
+    parser.add_argument("--beam-size",
+            type=int, default=12, help="Beam size")
+    parser.add_argument("--ignore-unk",
+            default=False, action="store_true",
+            help="Ignore unknown words")
+    parser.add_argument("--normalize",
+            action="store_true", default=False,
+            help="Normalize log-prob with the word count")
+    parser.add_argument("--port",
+            type=int, default=8765,
+            help="Listen on this port of 127.0.0.1")
+    parser.add_argument("--unix-socket",
+            help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch",
+            type=int, default=32,
+            help="Maximum number of sentences translated together")
+    parser.add_argument("--max-wait",
+            type=float, default=0.05,
+            help="How long (seconds) a request may wait for others to fill a batch")
+    parser.add_argument("--function-cache",
+            help="Directory to load the compiled functions from and save them to")
+    parser.add_argument("model_path",
+            help="Path to the model")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    state = prototype_state()
+    with open(args.state) as src:
+        state.update(cPickle.load(src))
+    state.update(eval("dict({})".format(args.changes)))
+
+    logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    rng = numpy.random.RandomState(state['seed'])
+    enc_dec = RNNEncoderDecoder(state, rng, skip_init=True)
+    enc_dec.build()
+    lm_model = enc_dec.create_lm_model()
+    lm_model.load(args.model_path)
+    if args.function_cache:
+        enc_dec.load_functions(args.function_cache)
+    beam_search = BeamSearch(enc_dec)
+    beam_search.compile()
+    if args.function_cache:
+        enc_dec.save_functions(args.function_cache)
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixServer(args.unix_socket, Handler)
+    else:
+        server = TCPServer(("127.0.0.1", args.port), Handler)
+    server.state = state
+    server.indx_word = cPickle.load(open(state['word_indx'], 'rb'))
+    server.idict_src = cPickle.load(open(state['indx_word'], 'r'))
+    server.batcher = Batcher(lm_model, beam_search, args.beam_size,
+            args.max_batch, args.max_wait,
+            ignore_unk=args.ignore_unk, normalize=args.normalize)
+
+    # The compiled functions are only used by the main thread
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Listening on {}".format(server.server_address))
+    server.batcher.run()
+
+if __name__ == "__main__":
+    main()
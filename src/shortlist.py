@@ -0,0 +1,73 @@
+import logging
+from collections import defaultdict
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+class Shortlist(object):
+    """Per-sentence target vocabulary for decoding.
+
+    The shortlist of a source sentence consists of the `n_frequent` most
+    frequent target words (the target vocabulary is sorted by frequency),
+    the words that are always allowed (end of sequence, UNK, unkpos*)
+    and the candidate translations of every source word.
+    """
+
+    def __init__(self, n_frequent, n_words, candidates=None, always=()):
+        """
+        :param n_words:
+            the size of the target vocabulary of the model, the words
+            outside of it are never shortlisted
+
+        :param candidates:
+            a dictionary from a source word index to an array
+            of target word indices, see load_candidates
+        """
+        self.candidates = {}
+        for src, trgt in (candidates or {}).items():
+            trgt = trgt[trgt < n_words]
+            if len(trgt):
+                self.candidates[src] = trgt
+        always = numpy.asarray(always, dtype="int64")
+        self.base = numpy.union1d(
+                numpy.arange(min(n_frequent, n_words), dtype="int64"),
+                always[always < n_words])
+
+    def __call__(self, seqs):
+        """Sorted target word indices for the source sequence(s).
+
+        For a list of sequences the union of their shortlists is returned.
+        """
+        if len(seqs) and numpy.ndim(seqs[0]) == 0:
+            seqs = [seqs]
+        words = [self.base]
+        for seq in seqs:
+            words += [self.candidates[w] for w in set(seq) if w in self.candidates]
+        return numpy.unique(numpy.hstack(words))
+
+def load_candidates(path, word_indx_src, word_indx_trgt, n_per_word):
+    """Read a source-conditioned candidate table.
+
+    Every line of the file is "source_word target_word [score]", e.g.
+    a lexical translation table produced by a word aligner. The
+    `n_per_word` best scoring target words are kept for every source
+    word, the words outside the vocabularies are ignored.
+    """
+    scored = defaultdict(list)
+    with open(path) as table:
+        for line in table:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            src, trgt = fields[:2]
+            score = float(fields[2]) if len(fields) > 2 else 0.
+            if src in word_indx_src and trgt in word_indx_trgt:
+                scored[word_indx_src[src]].append((score, word_indx_trgt[trgt]))
+    candidates = {}
+    for src, pairs in scored.items():
+        pairs.sort(reverse=True)
+        candidates[src] = numpy.array([trgt for score, trgt in pairs[:n_per_word]],
+                dtype="int64")
+    logger.debug("Loaded candidates for {} source words".format(len(candidates)))
+    return candidates
@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+# Sets the path
+import tiny
+
+from encoder_cache import EncoderCache
+
+# The cache of the workers, created before they are forked
+_cache = {}
+
+def encode(seq):
+    seq = numpy.asarray(seq, dtype="float32")
+    return [[numpy.outer(seq, numpy.arange(4, dtype="float32"))], [seq.sum(keepdims=True)]]
+
+def count_wrong(seqs):
+    """Look the sequences up twice, return the number of wrong values."""
+    cache = _cache['cache']
+    n_wrong = 0
+    for seq in seqs + seqs:
+        value = cache.get(seq, encode)
+        for arrays, expected in zip(value, encode(seq)):
+            n_wrong += not all(numpy.array_equal(a, e) for a, e in zip(arrays, expected))
+    return n_wrong
+
+class TestEncoderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+        # Only the last entry is kept in memory
+        _cache['cache'] = EncoderCache(1, self.path, 2 ** 20)
+
+    def tearDown(self):
+        _cache.clear()
+        shutil.rmtree(self.directory)
+
+    def test_disk(self):
+        seqs = [[i, i + 1, i + 2] for i in range(10)]
+        self.assertEqual(count_wrong(seqs), 0)
+        stats = _cache['cache'].stats()
+        self.assertEqual((stats['misses'], stats['disk_hits'], stats['hits']), (10, 10, 0))
+
+    def test_forked_workers(self):
+        # The file of the main process is written before the fork
+        count_wrong([[1, 2]])
+        batches = [[[i, j, j + 1] for j in range(10)] for i in range(8)]
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(pool.map(count_wrong, batches, chunksize=1), [0] * 8)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(len(os.listdir(self.directory)) > 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from tiny import tiny_state, tiny_model, source_seq
+
+from numpy_encdec import NumpyEncoderDecoder
+from sample import BeamSearch
+
+class TestNumpyEncoderDecoder(unittest.TestCase):
+    """The NumPy implementation computes what the Theano model does."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # With dropout the outputs are scaled, there is no noise when decoding
+        cls.state = tiny_state(cls.directory, dropout=0.5)
+        cls.enc_dec, lm_model = tiny_model(cls.state)
+        model_path = cls.directory + '/model.npz'
+        lm_model.save(model_path)
+        cls.numpy_enc_dec = NumpyEncoderDecoder(cls.state)
+        cls.numpy_enc_dec.create_lm_model().load(model_path)
+        cls.seqs = [source_seq(cls.state, words)
+                for words in [[3, 4, 5], [6, 7], [2, 9, 11, 13, 8]]]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_representation(self):
+        comp_repr = self.enc_dec.create_representation_computer()
+        comp_init_states = self.enc_dec.create_initializers()
+        for seq in self.seqs:
+            expected = comp_repr(seq)
+            actual = self.numpy_enc_dec.compute_representation(seq)
+            for e, a in zip(expected, actual):
+                numpy.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-5)
+            numpy.testing.assert_allclose(
+                    self.numpy_enc_dec.compute_initial_states(actual[0])[0],
+                    comp_init_states(expected[0])[0], rtol=1e-4, atol=1e-5)
+
+    def test_beam_step(self):
+        comp_step = self.enc_dec.create_beam_step_computer(alignment=True)
+        c, p_from_c = self.numpy_enc_dec.compute_representation(self.seqs[2])
+        c_mask = numpy.ones((len(c), 1), dtype="float32")
+        rng = numpy.random.RandomState(1)
+        origins = numpy.zeros(4, dtype="int64")
+        h = rng.randn(4, self.state['dim']).astype("float32")
+        ctx = rng.randn(4, c.shape[1]).astype("float32")
+        for k in range(3):
+            y = rng.randint(self.state['n_sym_target'], size=4)
+            args = [c[:, None], c_mask, p_from_c[:, None], origins, k, y, h, ctx]
+            expected = comp_step(*args)
+            actual = self.numpy_enc_dec.beam_step(*args, return_alignment=True)
+            for e, a in zip(expected, actual):
+                numpy.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-5)
+            h, ctx = expected[1:3]
+
+    def test_beam_search(self):
+        theano_search = BeamSearch(self.enc_dec)
+        theano_search.compile()
+        numpy_search = BeamSearch(self.numpy_enc_dec)
+        numpy_search.compile()
+        expected = theano_search.search_batch(self.seqs, 5)
+        actual = numpy_search.search_batch(self.seqs, 5)
+        for (e_trans, e_costs), (a_trans, a_costs) in zip(expected, actual):
+            self.assertEqual(map(list, a_trans), map(list, e_trans))
+            numpy.testing.assert_allclose(a_costs, e_costs, rtol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from tiny import tiny_state, tiny_model, source_seq, N_SYM_TARGET
+
+from numpy_encdec import NumpyEncoderDecoder
+from sample import BeamSearch, Profiler, cut_samples
+from shortlist import Shortlist
+
+class TestExtraSteps(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.state = tiny_state(cls.directory)
+        enc_dec, lm_model = tiny_model(cls.state)
+        cls.model_path = cls.directory + '/model.npz'
+        lm_model.save(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def search(self, seq, beam_size, minlen, **kwargs):
+        enc_dec = NumpyEncoderDecoder(self.state)
+        enc_dec.create_lm_model().load(self.model_path)
+        beam_search = BeamSearch(enc_dec, **kwargs)
+        beam_search.compile()
+        trans, costs = beam_search.search(seq, beam_size, minlen=minlen)
+        return trans, costs, beam_search.last_stats[0]
+
+    def test_beam_kept_during_extra_steps(self):
+        seq = source_seq(self.state, [6, 7])
+        max_steps = 3 * len(seq)
+        # Nothing can end before the extra steps
+        trans, costs, stats = self.search(seq, 5, minlen=max_steps)
+        lengths = map(len, trans)
+        self.assertEqual(len(trans), 5)
+        self.assertTrue(min(lengths) > max_steps)
+        # Some hypotheses end before the others, which go on
+        self.assertTrue(min(lengths) < max(lengths))
+        self.assertTrue(stats['forced'] > 0)
+        self.assertTrue(all(t[-1] == self.state['null_sym_target'] for t in trans))
+
+    def test_without_extra_steps(self):
+        seq = source_seq(self.state, [3, 4, 5])
+        max_steps = 3 * len(seq)
+        trans, costs, stats = self.search(seq, 5, minlen=max_steps,
+                extra_steps_factor=0)
+        # All the hypotheses are forced to end at the last step
+        self.assertEqual(len(trans), 5)
+        self.assertEqual(set(map(len, trans)), set([max_steps]))
+
+class NumpySearchTestCase(unittest.TestCase):
+    """Searches of the NumPy implementation of the tiny model."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.state = tiny_state(cls.directory)
+        enc_dec, lm_model = tiny_model(cls.state)
+        model_path = cls.directory + '/model.npz'
+        lm_model.save(model_path)
+        cls.enc_dec = NumpyEncoderDecoder(cls.state)
+        cls.enc_dec.create_lm_model().load(model_path)
+        cls.seqs = [source_seq(cls.state, words)
+                for words in [[3, 4, 5], [6, 7], [2, 9, 11, 13, 8]]]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+class TestShortlist(NumpySearchTestCase):
+
+    def search_batch(self, shortlist, seqs):
+        beam_search = BeamSearch(self.enc_dec, shortlist=shortlist)
+        beam_search.compile()
+        return beam_search.search_batch(seqs, 4)
+
+    def test_out_of_vocabulary(self):
+        eos = self.state['null_sym_target']
+        shortlist = Shortlist(100, N_SYM_TARGET,
+                {3: numpy.array([5, 20]), 6: numpy.array([30])}, [eos, 40])
+        self.assertEqual(list(shortlist(self.seqs[0])), range(N_SYM_TARGET))
+        self.assertEqual(list(shortlist(self.seqs[1])), range(N_SYM_TARGET))
+        for trans, costs in self.search_batch(shortlist, self.seqs):
+            self.assertEqual(len(trans), 4)
+
+    def test_per_sentence(self):
+        eos = self.state['null_sym_target']
+        shortlist = Shortlist(3, N_SYM_TARGET,
+                {3: numpy.array([5, 6]), 6: numpy.array([8, 9]),
+                    9: numpy.array([10, 11])}, [eos])
+        batch = self.search_batch(shortlist, self.seqs)
+        for seq, (trans, costs) in zip(self.seqs, batch):
+            allowed = set(shortlist(seq))
+            self.assertTrue(all(set(t) <= allowed for t in trans))
+            single_trans, single_costs = self.search_batch(shortlist, [seq])[0]
+            self.assertEqual(map(list, trans), map(list, single_trans))
+            numpy.testing.assert_allclose(costs, single_costs, rtol=1e-4)
+
+class TestProfiler(NumpySearchTestCase):
+
+    def test_profile_trace(self):
+        trace_path = self.directory + '/trace.jsonl'
+        profiler = Profiler(trace_path)
+        beam_search = BeamSearch(self.enc_dec, profiler=profiler)
+        beam_search.compile()
+        beam_search.search_batch(self.seqs[1:], 4, sentence_ids=[7, 3])
+        beam_search.search_batch(self.seqs[:1], 4)
+        profiler.save(self.directory + '/profile.json')
+        records = map(json.loads, open(trace_path))
+        # The sentences without ids are numbered in the order they came
+        self.assertEqual([r['sentence'] for r in records], [7, 3, 2])
+        self.assertEqual([r['max_steps'] for r in records],
+                [3 * len(seq) for seq in self.seqs[1:] + self.seqs[:1]])
+
+class TestCutSamples(unittest.TestCase):
+
+    def test_costs(self):
+        class LMModel(object):
+            word_indxs = {0: '<eol>', 1: 'a', 2: 'b'}
+        # Samples in columns, ending at their first <eol>
+        values = numpy.array([[1, 2, 0], [2, 0, 0], [0, 1, 0]])
+        cond_probs = numpy.array([[1., 2., 0.5], [1., 0.5, 3.], [0.5, 4., 2.]])
+        sentences, costs = cut_samples(LMModel(), values, cond_probs)
+        self.assertEqual(sentences, ["a b", "b", ""])
+        # The negative log-probabilities, as the costs of beam search
+        numpy.testing.assert_allclose(costs, [2.5, 2.5, 0.5])
+        sentences, costs = cut_samples(LMModel(), values, cond_probs, normalize=True)
+        numpy.testing.assert_allclose(costs, [1.25, 2.5, 0.5])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import cPickle
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+# Sets the flags Theano needs
+from tiny import tiny_state, tiny_model
+
+import theano
+
+import segment
+from phrase_cache import PhraseCache
+from sample import BeamSearch
+
+SENTENCES = ["s3 s4 s5\n", "s6 s7\n", "s2 s9 s11 s13\n"]
+# All the phrases of the sentences are different
+N_PHRASES = 6 + 3 + 10
+
+class CountingFunction(object):
+    """theano.function, counting the compiled functions by name."""
+
+    def __init__(self, function):
+        self.function = function
+        self.names = []
+
+    def __call__(self, *args, **kwargs):
+        self.names.append(kwargs.get('name'))
+        return self.function(*args, **kwargs)
+
+class CountingBeamSearch(BeamSearch):
+
+    n_compiled = 0
+
+    def compile(self):
+        CountingBeamSearch.n_compiled += 1
+        super(CountingBeamSearch, self).compile()
+
+class TestSegmentationEngine(unittest.TestCase):
+    """The models are compiled once, when the engine is created, and
+    used for all the sentences."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.function = theano.function
+        theano.function = self.compiled = CountingFunction(theano.function)
+        segment.BeamSearch = CountingBeamSearch
+        CountingBeamSearch.n_compiled = 0
+
+    def tearDown(self):
+        theano.function = self.function
+        segment.BeamSearch = BeamSearch
+        shutil.rmtree(self.directory)
+
+    def create_engine(self, reverse_model, cache=None):
+        state = tiny_state(self.directory)
+        enc_dec, lm_model = tiny_model(state)
+        state_fr2en = enc_dec_fr2en = lm_model_fr2en = None
+        if reverse_model:
+            state_fr2en = tiny_state(self.directory, reverse=True)
+            enc_dec_fr2en, lm_model_fr2en = tiny_model(state_fr2en, seed=2)
+        word_indx = cPickle.load(open(state['word_indx'], 'rb'))
+        word_indx_trgt = cPickle.load(open(state['word_indx_trgt'], 'rb'))
+        return segment.SegmentationEngine(lm_model, enc_dec,
+                word_indx, word_indx_trgt, state,
+                lm_model_fr2en, enc_dec_fr2en, state_fr2en, cache=cache)
+
+    def segment(self, engine, options):
+        console = StringIO.StringIO()
+        outputs = [(StringIO.StringIO(), StringIO.StringIO()) for opts in options]
+        segment.main_with_segmentation(engine, 0, len(SENTENCES) - 1, 3,
+                SENTENCES, console, options, outputs)
+        self.assertEqual(console.getvalue().split(),
+                map(str, range(len(SENTENCES))))
+        for f_trans, f_total in outputs:
+            self.assertEqual(len(f_trans.getvalue().splitlines()), len(SENTENCES))
+
+    def check_compiled_once(self, reverse_model, options):
+        engine = self.create_engine(reverse_model)
+        compiled = list(self.compiled.names)
+        # Every function of every model is compiled once
+        self.assertEqual(sorted(set(compiled)), sorted(compiled))
+        self.assertEqual('score_fn' in compiled, reverse_model)
+        self.segment(engine, options)
+        self.assertEqual(self.compiled.names, compiled)
+        self.assertEqual(CountingBeamSearch.n_compiled, 1)
+
+    def test_forward_model(self):
+        self.check_compiled_once(False, [dict(), dict(normalize=True)])
+
+    def test_reverse_scores(self):
+        self.check_compiled_once(True, [dict(),
+            dict(reverse_score=True),
+            dict(normalize=True),
+            dict(normalize=True, reverse_score=True)])
+
+    def check_cache_stats(self, max_entries):
+        engine = self.create_engine(False, PhraseCache('tiny', max_entries))
+        self.segment(engine, [dict()])
+        stats = engine.cache.stats()
+        # Every phrase is looked up and translated once
+        self.assertEqual((stats['hits'], stats['misses']), (0, N_PHRASES))
+        return engine
+
+    def test_cache_stats(self):
+        engine = self.check_cache_stats(100)
+        self.segment(engine, [dict()])
+        stats = engine.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (N_PHRASES, N_PHRASES))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_small_cache(self):
+        self.check_cache_stats(2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""A tiny RNNsearch model with random parameters for the tests.
+
+The tests are run from the src directory:
+
+    python -m unittest discover -s test -p "test_*.py"
+"""
+
+import cPickle
+import os
+import sys
+
+# See Known Issues in README.md
+os.environ.setdefault('THEANO_FLAGS', 'floatX=float32,on_unused_input=warn')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from state import prototype_search_state
+
+N_SYM_SOURCE = 15
+N_SYM_TARGET = 13
+
+def tiny_state(directory, reverse=False, **changes):
+    """A state of a small RNNsearch model, its dictionaries are written
+    to `directory`. The source words are "s2" .. "s13", the target
+    ones "t2" .. "t11", or the other way round if `reverse`."""
+    languages = [('s', N_SYM_SOURCE), ('t', N_SYM_TARGET)]
+    if reverse:
+        languages.reverse()
+    (source_prefix, n_sym_source), (target_prefix, n_sym_target) = languages
+    state = prototype_search_state()
+    state.update(dict(dim=8, rank_n_approx=5,
+        n_sym_source=n_sym_source, n_sym_target=n_sym_target,
+        null_sym_source=n_sym_source - 1, null_sym_target=n_sym_target - 1,
+        seqlen=20, bs=4))
+    state.update(changes)
+    for name, prefix, n_sym in [('source', source_prefix, n_sym_source),
+            ('target', target_prefix, n_sym_target)]:
+        words = dict((i, '{}{}'.format(prefix, i)) for i in range(2, n_sym - 1))
+        words[0] = '<s>'
+        indx_path = os.path.join(directory, 'ivocab.{}.pkl'.format(prefix))
+        word_path = os.path.join(directory, 'vocab.{}.pkl'.format(prefix))
+        with open(indx_path, 'wb') as dst:
+            cPickle.dump(words, dst)
+        with open(word_path, 'wb') as dst:
+            cPickle.dump(dict((w, i) for i, w in words.items()), dst)
+        if name == 'source':
+            state['indx_word'], state['word_indx'] = indx_path, word_path
+        else:
+            state['indx_word_target'], state['word_indx_trgt'] = indx_path, word_path
+    return state
+
+def tiny_model(state, seed=1):
+    """Build the Theano model of the state with random parameters.
+
+    Returns the RNNEncoderDecoder and its LM model, nothing is compiled.
+    """
+    from encdec import RNNEncoderDecoder
+
+    enc_dec = RNNEncoderDecoder(state, numpy.random.RandomState(seed),
+            skip_init=True)
+    enc_dec.build()
+    lm_model = enc_dec.create_lm_model()
+    rng = numpy.random.RandomState(seed)
+    for param in lm_model.params:
+        value = param.get_value()
+        param.set_value((0.5 * rng.randn(*value.shape)).astype(value.dtype))
+    return enc_dec, lm_model
+
+def source_seq(state, words):
+    """The word indices of a source sentence given as word numbers."""
+    return numpy.array(list(words) + [state['null_sym_source']], dtype="int64")
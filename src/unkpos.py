@@ -0,0 +1,106 @@
+"""Replacement of the positional unknown words in translations.
+
+preprocess.py --target replaces every target word outside the vocabulary
+by a token telling where its aligned source word is, relative to the
+position of the target word: unkposK for K words back, unkpos_K for K
+words ahead (K <= 7, unkpos0 for the same position) and unkposn for
+anything further. The Replacer puts the source words back.
+"""
+
+import logging
+import re
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+UNKPOS_RE = re.compile(r"^unkpos(_?)(\d+)$")
+
+def load_dictionary(path):
+    """Read a dictionary of "source_word target_word" lines,
+    e.g. of proper nouns. The first translation of a word is kept."""
+    dictionary = {}
+    with open(path) as src:
+        for line in src:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] not in dictionary:
+                dictionary[fields[0]] = fields[1]
+    logger.debug("Loaded {} dictionary entries".format(len(dictionary)))
+    return dictionary
+
+class Replacer(object):
+    """Replaces the unkpos tokens of a batch of translations at once.
+
+    An unkpos token becomes the source word at its offset, translated
+    by the dictionary if it is there. unkposn, and the tokens pointing
+    outside of the source sentence, use the source position the
+    attention was the highest at if the alignments are given, and are
+    left as they are otherwise.
+    """
+
+    def __init__(self, word_indxs, dictionary=None, eos_id=0):
+        """
+        :param word_indxs: a dictionary from target word indices to words
+        """
+        self.eos_id = eos_id
+        self.dictionary = dictionary if dictionary is not None else {}
+        n_words = max(word_indxs) + 1
+        self.words = numpy.empty(n_words, dtype=object)
+        self.words[word_indxs.keys()] = word_indxs.values()
+        self.offsets = numpy.zeros(n_words, dtype="int64")
+        self.is_unkpos = numpy.zeros(n_words, dtype="bool")
+        self.is_unkposn = numpy.zeros(n_words, dtype="bool")
+        for indx, word in word_indxs.items():
+            match = UNKPOS_RE.match(word)
+            if match:
+                ahead, distance = match.groups()
+                self.offsets[indx] = int(distance) if ahead else -int(distance)
+                self.is_unkpos[indx] = True
+            elif word == 'unkposn':
+                self.is_unkpos[indx] = True
+                self.is_unkposn[indx] = True
+
+    def __call__(self, trans, sources, alignments=None):
+        """Translations with the unkpos tokens replaced.
+
+        :param trans: a list of translations as arrays of word indices
+        :param sources: the source words of every translation
+        :param alignments:
+            optionally, for every translation the source position of
+            the highest attention at every target position
+        :returns: the translations as strings, cut at the end of sequence
+        """
+        n_trans = len(trans)
+        if not n_trans:
+            return []
+        padded = numpy.zeros((n_trans, max(map(len, trans))), dtype="int64")
+        padded.fill(self.eos_id)
+        for i, t in enumerate(trans):
+            padded[i, :len(t)] = t
+        is_eos = padded == self.eos_id
+        lengths = numpy.where(is_eos.any(axis=1), is_eos.argmax(axis=1),
+                padded.shape[1])
+
+        # The source words, translated by the dictionary, padded with None
+        src_lens = numpy.array(map(len, sources))
+        src = numpy.empty((n_trans, src_lens.max() + 1), dtype=object)
+        for i, words in enumerate(sources):
+            src[i, :len(words)] = [self.dictionary.get(w, w) for w in words]
+
+        positions = numpy.arange(padded.shape[1])[None, :] + self.offsets[padded]
+        is_unkposn = self.is_unkposn[padded]
+        inside = (positions >= 0) & (positions < src_lens[:, None])
+        if alignments is not None:
+            aligned = numpy.zeros(padded.shape, dtype="int64") - 1
+            for i, a in enumerate(alignments):
+                aligned[i, :len(a)] = a
+            positions = numpy.where(is_unkposn | ~inside, aligned, positions)
+            inside = (positions >= 0) & (positions < src_lens[:, None])
+        else:
+            inside &= ~is_unkposn
+        replaced = self.is_unkpos[padded] & inside
+
+        words = self.words[padded]
+        rows, columns = replaced.nonzero()
+        words[rows, columns] = src[rows, positions[rows, columns]]
+        return [" ".join(words[i, :length]) for i, length in enumerate(lengths)]